@@ -1,178 +1,928 @@
+import functools
+import os
+import threading
 import time
-import sqlite3
-from flask import Flask, request
-from flask_socketio import SocketIO, emit
+from flask import Flask, abort, request, send_file
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_login import current_user
 
-from db import DB_PATH
+import blobstore
+from archive import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH, Archive
+import dbpool
+import thumbs
+import uploads
+import wire
+from writer import writer
+from maintenance import MAINT_TICK, Maintenance
+from presence import PRESENCE_WINDOW, Presence, SharedPresence
+from recent import RecentRooms
+from db import has_search_index, init_db
 
 app = Flask(__name__)
-socketio = SocketIO(app)
-active_users = {}
+# with a message queue (e.g. redis://localhost:6379/0) several worker
+# processes can serve clients and every broadcast reaches all of them
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None
+# wire.dumps lets packets embed cached, pre-encoded messages
+socketio = SocketIO(app, json=wire, message_queue=SOCKETIO_MESSAGE_QUEUE)
+init_db()
+# users expire PRESENCE_TTL after their last ping; changes go out from
+# presence_loop at most once per PRESENCE_WINDOW. Clients that connect with
+# auth {presence: 'delta'} get a versioned snapshot and then join/leave
+# deltas, 'none' opts out, and everyone else keeps full user lists
+presence = SharedPresence(writer, dbpool.pool) if SOCKETIO_MESSAGE_QUEUE else Presence()
+presence_task = None
 sid_to_user = {}
+wire_cache = wire.WireCache()
+# wire options negotiated by clients that speak the paged/streamed history
+# protocol: {'proto': 1 or 2, 'z': accepts deflated pages}. Legacy clients
+# are absent and get bare lists
+client_wire = {}
+# chat room of each socket; None is the lobby. Each room maps to the
+# Socket.IO room `chat:<name>` and messages are only broadcast there
+client_room = {}
+CHAT_ROOM_MAX_LEN = 64
+PRESENCE_DELTA_ROOM = 'presence:delta'
+PRESENCE_LIST_ROOM = 'presence:list'
+# messages whose like count changed; likes_loop broadcasts their counts to
+# each message's room at most once per LIKE_WINDOW
+pending_likes = set()
+pending_likes_lock = threading.Lock()
+likes_task = None
 
-
-def get_active_users():
-    now = time.time()
-    return [u for u, t in active_users.items() if now - t < 30]
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", 100))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", 500))
+RESYNC_MAX_GAP = int(os.environ.get("RESYNC_MAX_GAP", 500))
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 50))
+SEARCH_LIMIT = int(os.environ.get("SEARCH_LIMIT", 100))
+LIKE_WINDOW = float(os.environ.get("LIKE_WINDOW", 0.5))
+COMMENT_MAX_LEN = int(os.environ.get("COMMENT_MAX_LEN", 2000))
+# seconds between archiver passes; 0 leaves archiving to `python archive.py`
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 3600))
+archive_task = None
+# checkpoints, ANALYZE and incremental vacuum in small timed steps
+maintenance = Maintenance()
+maintenance_task = None
 
 
 def safe_emit(event, data=None, to=None):
     socketio.emit(event, data, to=to)
 
 
-@socketio.on('connect')
-def chat_connect():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(
-            """
-            SELECT user, message, image, file, file_name, file_type, timestamp FROM chat_messages
-            ORDER BY timestamp
-            """
-        )
-        rows = c.fetchall()
-        history = [
-            {
-                "user": r[0],
-                "message": r[1],
-                "image": r[2],
-                "file": r[3],
-                "file_name": r[4],
-                "file_type": r[5],
-                "fileName": r[4],
-                "fileType": r[5],
-                "timestamp": r[6],
-            }
-            for r in rows
-        ]
-    safe_emit('chat_history', history, to=request.sid)
-    safe_emit(
-        'active_user_update',
-        {'users': get_active_users(), 'count': len(get_active_users())},
-        to=request.sid,
+def presence_loop():
+    while True:
+        socketio.sleep(PRESENCE_WINDOW)
+        # a failed round (database busy, queue down) must not end the task
+        try:
+            presence.expire()
+            delta = presence.take_delta()
+            if delta is not None:
+                safe_emit('presence_delta', delta, to=PRESENCE_DELTA_ROOM)
+                safe_emit('active_user_update', presence.snapshot(), to=PRESENCE_LIST_ROOM)
+        except Exception as e:
+            print(f"presence update failed: {e!r}")
+
+
+def start_presence_task():
+    global presence_task
+    if presence_task is None:
+        presence_task = socketio.start_background_task(presence_loop)
+
+
+MESSAGE_FIELDS = (
+    "id", "user", "message", "image", "file", "file_name", "file_type", "timestamp",
+    "blob_hash", "blob_size", "blob_type", "ts", "room",
+)
+MESSAGE_COLUMNS = ", ".join(MESSAGE_FIELDS)
+# field order of the compact (proto 2) row encoding
+COMPACT_KEYS = (
+    "id", "user", "message", "image", "file", "file_name", "file_type", "timestamp",
+    "attachment", "ts", "room",
+)
+BLOB_MAX_AGE = 365 * 24 * 3600
+
+# recent history of the busiest rooms is answered from memory; only older
+# pages hit SQLite
+recent = RecentRooms(MESSAGE_COLUMNS, MESSAGE_FIELDS.index("room"))
+# messages older than ARCHIVE_AFTER_DAYS, in monthly files beside app.db
+archive = Archive(MESSAGE_FIELDS)
+
+with dbpool.connection() as _conn:
+    SEARCH_FTS = has_search_index(_conn)
+recent.room(None, dbpool.connection)
+
+
+def row_to_message(r):
+    image, file, file_type, attachment = r[3], r[4], r[6] or r[10], None
+    if r[8]:
+        # stored attachments are referenced by URL instead of shipped inline
+        url = blobstore.blob_url(r[8])
+        attachment = {"url": url, "hash": r[8], "size": r[9], "type": r[10]}
+        if thumbs.supports(r[10]):
+            attachment["thumb"] = f"{url}/thumb"
+        if (r[10] or "").startswith("image/"):
+            image = url
+        else:
+            file = url
+    return {
+        "id": r[0],
+        "user": r[1],
+        "message": r[2],
+        "image": image,
+        "file": file,
+        "file_name": r[5],
+        "file_type": file_type,
+        "fileName": r[5],
+        "fileType": file_type,
+        "timestamp": r[7],
+        "ts": r[11],
+        "room": r[12],
+        "attachment": attachment,
+    }
+
+
+def encode_row(r):
+    # each message is serialized once and reused by every broadcast,
+    # history page and search hit that includes it
+    return wire_cache.get((r[0], 'json'), lambda: wire.encode(row_to_message(r)))
+
+
+def encode_compact_row(r):
+    def build():
+        message = row_to_message(r)
+        return wire.encode([message[k] for k in COMPACT_KEYS])
+
+    return wire_cache.get((r[0], 'row'), build)
+
+
+def negotiate_wire(sid, options):
+    # proto 1: streamed chunks of message objects; proto 2: columnar chunks,
+    # each deflated from WIRE_COMPRESS_MIN bytes when the client sets `z`
+    try:
+        proto = int(options.get('proto') or 1)
+    except (TypeError, ValueError):
+        proto = 1
+    settings = {'proto': min(max(proto, 1), 2), 'z': bool(options.get('z'))}
+    client_wire[sid] = settings
+    return settings
+
+
+def chunk_payload(rows, to):
+    settings = client_wire.get(to) or {}
+    if settings.get('proto', 1) < 2:
+        return {'messages': [encode_row(r) for r in rows]}
+    return wire.columnar(
+        COMPACT_KEYS, [encode_compact_row(r) for r in rows], settings.get('z')
+    )
+
+
+def parse_id(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def page_limit(value):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return HISTORY_PAGE_SIZE
+    return max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+
+def iter_chunks(rows, size=STREAM_CHUNK_SIZE):
+    # rows is a cursor (read with fetchmany) or an in-memory list
+    if isinstance(rows, list):
+        for i in range(0, len(rows), size):
+            yield rows[i:i + size]
+        return
+    while True:
+        chunk = rows.fetchmany(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def row_events(event, rows, to, **meta):
+    # yield `<event>_chunk` payloads of at most STREAM_CHUNK_SIZE messages,
+    # then a `<event>_end` marker, without holding the whole result set
+    seq = 0
+    count = 0
+    for rows in iter_chunks(rows):
+        yield f'{event}_chunk', {'seq': seq, **chunk_payload(rows, to), **meta}
+        seq += 1
+        count += len(rows)
+    yield f'{event}_end', {'chunks': seq, 'count': count, **meta}
+
+
+def emit_events(events, to):
+    # the *_events generators produce (event, payload) pairs and are shared
+    # with async_app.py, which consumes them on its database threads
+    for event, data in events:
+        safe_emit(event, data, to=to)
+
+
+def history_query(conn, before_id=None, limit=HISTORY_PAGE_SIZE, room=None):
+    # keyset pagination on (room, id): find the row just past the page first,
+    # so the page itself is a plain ascending range scan that can be streamed
+    clauses = ["room IS ?"]
+    params = (room,)
+    if before_id is not None:
+        clauses.append("id < ?")
+        params += (before_id,)
+    boundary = conn.execute(
+        f"SELECT id FROM chat_messages WHERE {' AND '.join(clauses)} "
+        "ORDER BY id DESC LIMIT 1 OFFSET ?",
+        params + (limit,),
+    ).fetchone()
+    if boundary is not None:
+        clauses.append("id > ?")
+        params += (boundary[0],)
+    cursor = conn.execute(
+        f"SELECT {MESSAGE_COLUMNS} FROM chat_messages WHERE {' AND '.join(clauses)} ORDER BY id",
+        params,
+    )
+    return cursor, boundary is not None
+
+
+def fetch_rows_after(after_id, limit):
+    with dbpool.connection() as conn:
+        return conn.execute(
+            f"SELECT {MESSAGE_COLUMNS} FROM chat_messages WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        ).fetchall()
+
+
+def recent_room(room):
+    # other workers and the Node server insert too; pick up their rows
+    # before answering from memory (a rowid range probe when there are none).
+    # Catching up first means a buffer dropped for a long gap is warmed anew
+    recent.catch_up(fetch_rows_after)
+    return recent.room(room, dbpool.connection)
+
+
+def with_archived(rows, before_id, limit, room):
+    # a page that ran out of hot rows continues into the archives, whose ids
+    # are all lower
+    if rows:
+        before_id = rows[0][0]
+    older, has_more = archive.page(before_id, limit - len(rows), room)
+    return older + list(rows), has_more
+
+
+def fetch_history_page(before_id=None, limit=HISTORY_PAGE_SIZE, room=None):
+    cached = recent_room(room).page(before_id, limit)
+    if cached is not None:
+        rows, has_more = cached
+    else:
+        with dbpool.connection() as conn:
+            cursor, has_more = history_query(conn, before_id, limit, room)
+            rows = cursor.fetchall()
+    if not has_more:
+        rows, _ = with_archived(rows, before_id, limit, room)
+    return [encode_row(r) for r in rows]
+
+
+def history_events(to, before_id=None, limit=HISTORY_PAGE_SIZE, room=None, **meta):
+    meta.update(before_id=before_id, room=room)
+    cached = recent_room(room).page(before_id, limit)
+    if cached is not None:
+        rows, has_more = cached
+        if not has_more:
+            rows, has_more = with_archived(rows, before_id, limit, room)
+        yield from row_events('chat_history', rows, to, has_more=has_more, **meta)
+        return
+    with dbpool.connection() as conn:
+        cursor, has_more = history_query(conn, before_id, limit, room)
+        if has_more:
+            yield from row_events('chat_history', cursor, to, has_more=True, **meta)
+            return
+        rows = cursor.fetchall()
+    # the oldest hot page is never more than `limit` rows, so it can be held
+    rows, has_more = with_archived(rows, before_id, limit, room)
+    yield from row_events('chat_history', rows, to, has_more=has_more, **meta)
+
+
+def stream_history_page(to, before_id=None, limit=HISTORY_PAGE_SIZE, room=None, **meta):
+    emit_events(history_events(to, before_id, limit, room, **meta), to)
+
+
+def resync_query(conn, after_id, room=None):
+    # the room's rows above after_id, or None when more than RESYNC_MAX_GAP
+    # were missed
+    too_far = conn.execute(
+        "SELECT id FROM chat_messages WHERE room IS ? AND id > ? ORDER BY id LIMIT 1 OFFSET ?",
+        (room, after_id, RESYNC_MAX_GAP),
+    ).fetchone()
+    if too_far is not None:
+        return None
+    return conn.execute(
+        f"SELECT {MESSAGE_COLUMNS} FROM chat_messages WHERE room IS ? AND id > ? ORDER BY id",
+        (room, after_id),
     )
 
 
+def resync_events(to, after_id, room=None):
+    cached = recent_room(room).after(after_id, RESYNC_MAX_GAP)
+    if cached is not None:
+        yield from row_events('chat_resync', cached, to, after_id=after_id, room=room)
+        return
+    with dbpool.connection() as conn:
+        cursor = resync_query(conn, after_id, room)
+        if cursor is not None:
+            yield from row_events('chat_resync', cursor, to, after_id=after_id, room=room)
+            return
+    # too far behind: the client should drop its feed and start over
+    yield from history_events(to, room=room, reset=True)
+
+
+def stream_resync(to, after_id, room=None):
+    emit_events(resync_events(to, after_id, room), to)
+
+
+def room_name(value):
+    # a chat room name from client input; None (the lobby) when blank
+    if not isinstance(value, str):
+        return None
+    value = value.strip()[:CHAT_ROOM_MAX_LEN]
+    return value or None
+
+
+def room_channel(room):
+    return f'chat:{room or ""}'
+
+
+def switch_chat_room(sid, room):
+    # record sid's chat room; returns the Socket.IO rooms to leave (None if
+    # there is none) and to join
+    previous = room_channel(client_room[sid]) if sid in client_room else None
+    client_room[sid] = room
+    return previous, room_channel(room)
+
+
+def enter_chat_room(sid, room):
+    leave, join = switch_chat_room(sid, room)
+    if leave == join:
+        return
+    if leave is not None:
+        leave_room(leave, sid=sid)
+    join_room(join, sid=sid)
+
+
+@socketio.on('connect')
+def chat_connect(auth=None):
+    room = room_name(auth.get('room')) if isinstance(auth, dict) else None
+    enter_chat_room(request.sid, room)
+    if isinstance(auth, dict) and (auth.get('paged') or auth.get('proto')):
+        negotiate_wire(request.sid, auth)
+        last_id = parse_id(auth.get('last_id'))
+        if last_id is not None:
+            stream_resync(request.sid, last_id, room)
+        else:
+            stream_history_page(request.sid, room=room)
+    else:
+        safe_emit('chat_history', fetch_history_page(room=room), to=request.sid)
+    start_presence_task()
+    start_archive_task()
+    start_maintenance_task()
+    mode = auth.get('presence') if isinstance(auth, dict) else None
+    if mode == 'delta':
+        join_room(PRESENCE_DELTA_ROOM)
+        safe_emit('presence_snapshot', presence.snapshot(), to=request.sid)
+    elif mode != 'none':
+        join_room(PRESENCE_LIST_ROOM)
+        safe_emit('active_user_update', presence.snapshot(), to=request.sid)
+
+
+@socketio.on('get_presence')
+def get_presence():
+    # delta clients ask again after noticing a version gap
+    safe_emit('presence_snapshot', presence.snapshot(), to=request.sid)
+
+
 @socketio.on('get_chat_history')
-def get_chat_history():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(
-            """
-            SELECT user, message, image, file, file_name, file_type, timestamp FROM chat_messages
-            ORDER BY timestamp
-            """
-        )
-        rows = c.fetchall()
-        history = [
-            {
-                "user": r[0],
-                "message": r[1],
-                "image": r[2],
-                "file": r[3],
-                "file_name": r[4],
-                "file_type": r[5],
-                "fileName": r[4],
-                "fileType": r[5],
-                "timestamp": r[6],
-            }
-            for r in rows
-        ]
-    emit('chat_history', history)
+def get_chat_history(data=None):
+    # legacy clients send no payload and expect a bare list of the newest page
+    room = client_room.get(request.sid)
+    if not isinstance(data, dict):
+        emit('chat_history', fetch_history_page(room=room))
+        return
+    if 'proto' in data:
+        negotiate_wire(request.sid, data)
+    before_id = parse_id(data.get('before_id'))
+    stream_history_page(request.sid, before_id, page_limit(data.get('limit')), room)
 
 
-@socketio.on('chat_message')
-def handle_chat_message(data):
+@socketio.on('resync_chat')
+def resync_chat(data=None):
+    room = client_room.get(request.sid)
+    last_id = parse_id(data.get('last_id')) if isinstance(data, dict) else None
+    if last_id is None:
+        stream_history_page(request.sid, room=room)
+        return
+    stream_resync(request.sid, last_id, room)
+
+
+def room_history(sid, room):
+    # what a socket gets after switching rooms: the newest page, flagged as
+    # a reset for paged clients
+    if sid in client_wire:
+        stream_history_page(sid, room=room, reset=True)
+    else:
+        safe_emit('chat_history', fetch_history_page(room=room), to=sid)
+
+
+@socketio.on('join_room')
+def join_chat_room(data=None):
+    room = room_name(data.get('room')) if isinstance(data, dict) else None
+    enter_chat_room(request.sid, room)
+    room_history(request.sid, room)
+
+
+@socketio.on('leave_room')
+def leave_chat_room(data=None):
+    enter_chat_room(request.sid, None)
+    room_history(request.sid, None)
+
+
+def read_chat_message(data):
+    # (msg, img, file, file_name, file_type), or None when there's nothing to post
+    if not isinstance(data, dict):
+        return None
     msg = (data.get('message') or '').strip()
     img = data.get('image')
     file = data.get('file')
+    if not msg and not img and not file:
+        return None
     file_name = data.get('file_name') or data.get('fileName')
     file_type = data.get('file_type') or data.get('fileType')
-    if not msg and not img and not file:
+    return msg, img, file, file_name, file_type
+
+
+def post_chat_message(username, msg, img, file, file_name, file_type, room=None):
+    blob = blobstore.put_data_url(img or file)
+    if blob is not None:
+        img = file = None
+    return store_message(username, msg, img, file, file_name, file_type, blob, room)
+
+
+@socketio.on('chat_message')
+def handle_chat_message(data):
+    fields = read_chat_message(data)
+    if fields is None:
         return
     if not current_user.is_authenticated:
         emit('chat_error', 'Login required to send messages.')
         return
-    username = current_user.username
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            'INSERT INTO chat_messages (user, message, image, file, file_name, file_type) VALUES (?, ?, ?, ?, ?, ?)',
-            (username, msg, img, file, file_name, file_type),
+    room = client_room.get(request.sid)
+    broadcast_message(post_chat_message(current_user.username, *fields, room=room))
+
+
+def store_message(username, msg, img=None, file=None, file_name=None, file_type=None, blob=None,
+                  room=None):
+    blob = blob or (None, None, None)
+    now = time.time()
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now))
+    ts = int(now * 1000)
+    # group-committed by the writer thread; blocks until the row is durable
+    row_id = writer.execute(
+        """
+        INSERT INTO chat_messages
+          (user, message, image, file, file_name, file_type, timestamp,
+           blob_hash, blob_size, blob_type, ts, room)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (username, msg, img, file, file_name, file_type, timestamp, *blob, ts, room),
+    )
+    row = (row_id, username, msg, img, file, file_name, file_type, timestamp, *blob, ts, room)
+    recent.append(row, fetch_rows_after)
+    return row
+
+
+def broadcast_message(row):
+    # only the members of the message's room receive it
+    safe_emit('chat_message', encode_row(row), to=room_channel(row[12]))
+
+
+# Chunked, resumable uploads. Handlers answer through Socket.IO acks:
+# upload_init -> {upload_id, chunk_size}; upload_chunk writes binary data at
+# an offset; upload_status lists the ranges still missing; upload_finish
+# stores the file and posts it as a chat message.
+def upload_handler(f):
+    @functools.wraps(f)
+    def wrapper(data=None):
+        if not current_user.is_authenticated:
+            return {'error': 'Login required to send messages.'}
+        if not isinstance(data, dict):
+            return {'error': 'Invalid request.'}
+        try:
+            return f(current_user.username, data)
+        except uploads.UploadError as e:
+            return {'error': str(e)}
+    return wrapper
+
+
+def upload_init(username, data):
+    meta = uploads.start(
+        username,
+        data.get('size'),
+        data.get('file_name') or data.get('fileName'),
+        data.get('file_type') or data.get('fileType'),
+    )
+    return {'upload_id': meta['id'], 'chunk_size': uploads.UPLOAD_CHUNK_MAX}
+
+
+def upload_chunk(username, data):
+    meta = uploads.write_chunk(username, data.get('upload_id'), data.get('offset'), data.get('data'))
+    return {'missing': uploads.missing(meta)}
+
+
+def upload_status(username, data):
+    meta = uploads.status(username, data.get('upload_id'))
+    return {'size': meta['size'], 'missing': uploads.missing(meta)}
+
+
+def finish_upload(username, data, room=None):
+    meta, blob = uploads.finish(username, data.get('upload_id'))
+    msg = (data.get('message') or '').strip()
+    return store_message(
+        username, msg, file_name=meta['name'], file_type=meta['type'], blob=blob, room=room
+    )
+
+
+def upload_finish(username, data):
+    row = finish_upload(username, data, client_room.get(request.sid))
+    broadcast_message(row)
+    return {'id': row[0]}
+
+
+# each action answers through the Socket.IO ack
+UPLOAD_ACTIONS = {
+    'upload_init': upload_init,
+    'upload_chunk': upload_chunk,
+    'upload_status': upload_status,
+    'upload_finish': upload_finish,
+}
+for _event, _action in UPLOAD_ACTIONS.items():
+    socketio.on(_event)(upload_handler(_action))
+
+
+@app.route('/blobs/<digest>')
+def serve_blob(digest):
+    if not blobstore.is_digest(digest):
+        abort(404)
+    path = blobstore.blob_path(digest)
+    if not os.path.exists(path):
+        abort(404)
+    # content never changes for a given digest, so it is its own ETag;
+    # conditional=True answers If-None-Match and Range requests
+    mimetype = blob_type(digest)
+    if not blobstore.is_inline(mimetype):
+        return immutable_file(path, 'application/octet-stream', digest, attachment=True)
+    return immutable_file(path, mimetype, digest)
+
+
+@app.route('/blobs/<digest>/thumb')
+def serve_thumb(digest):
+    if not blobstore.is_digest(digest):
+        abort(404)
+    path = thumbs.thumbnail(digest, blob_type(digest))
+    if path is None:
+        abort(404)
+    return immutable_file(path, 'image/jpeg', f'{digest}-thumb{thumbs.THUMB_SIZE}')
+
+
+def blob_type(digest):
+    with dbpool.connection() as conn:
+        row = conn.execute(
+            'SELECT blob_type FROM chat_messages WHERE blob_hash = ? LIMIT 1', (digest,)
+        ).fetchone()
+    if row is None:
+        row = (archive.blob_type(digest),)
+    return row[0] or 'application/octet-stream'
+
+
+def immutable_file(path, mimetype, etag, attachment=False):
+    response = send_file(
+        path, mimetype=mimetype, conditional=True, etag=etag, max_age=BLOB_MAX_AGE,
+        as_attachment=attachment,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    # uploads are user content on our origin: never sniffed, never scripted
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = "default-src 'none'; sandbox"
+    return response
+
+
+def fts_query(text):
+    # every word becomes a quoted prefix term, so input can't inject FTS syntax
+    words = text.split()
+    return " ".join('"' + w.replace('"', '""') + '"*' for w in words)
+
+
+def search_query(conn, query, limit=SEARCH_LIMIT, room=None):
+    if SEARCH_FTS:
+        columns = ", ".join(f"m.{f}" for f in MESSAGE_FIELDS)
+        return conn.execute(
+            f"""
+            SELECT {columns} FROM chat_messages_fts
+            JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+            WHERE chat_messages_fts MATCH ? AND m.room IS ?
+            ORDER BY chat_messages_fts.rank LIMIT ?
+            """,
+            (fts_query(query), room, limit),
         )
-        conn.commit()
-    safe_emit(
-        'chat_message',
-        {
-            'user': username,
-            'message': msg,
-            'image': img,
-            'file': file,
-            'file_name': file_name,
-            'file_type': file_type,
-            'fileName': file_name,
-            'fileType': file_type,
-        },
+    return conn.execute(
+        f"""
+        SELECT {MESSAGE_COLUMNS} FROM chat_messages
+        WHERE room IS ? AND (message LIKE ? OR user LIKE ?)
+        ORDER BY id DESC LIMIT ?
+        """,
+        (room, f'%{query}%', f'%{query}%', limit),
     )
 
 
+def search_rows(query, limit=SEARCH_LIMIT, room=None):
+    # hot matches first, then the archives newest month first
+    with dbpool.connection() as conn:
+        rows = search_query(conn, query, limit, room).fetchall()
+    if len(rows) < limit:
+        rows += archive.search(fts_query(query), f'%{query}%', limit - len(rows), room)
+    return rows
+
+
+def search_events(to, query, room=None):
+    if not query:
+        yield 'chat_search_end', {'chunks': 0, 'count': 0, 'query': query, 'room': room}
+        return
+    yield from row_events('chat_search', search_rows(query, room=room), to, query=query, room=room)
+
+
+def search_results(query, room=None):
+    # legacy clients get one list
+    if not query:
+        return []
+    return [encode_row(r) for r in search_rows(query, room=room)]
+
+
 @socketio.on('search_chat')
 def search_chat(data):
     query = (data.get('query') or '').strip()
-    if not query:
-        emit('chat_search_results', [])
-        return
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(
-            """
-            SELECT user, message, image, file, file_name, file_type, timestamp FROM chat_messages
-            WHERE message LIKE ? OR user LIKE ?
-            ORDER BY timestamp
+    room = client_room.get(request.sid)
+    if request.sid in client_wire:
+        emit_events(search_events(request.sid, query, room), request.sid)
+    else:
+        emit('chat_search_results', search_results(query, room))
+
+
+def archive_old_messages(days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH):
+    # move messages older than `days` into the archives, oldest first and
+    # `batch` rows at a time: each batch is durable in its month file before
+    # the writer deletes it here, so a crash in between only means the next
+    # pass stores it again (a no-op). Returns how many rows moved.
+    cutoff = int((time.time() - days * 86400) * 1000)
+    with dbpool.connection() as conn:
+        # archive a prefix of the id order: everything below the oldest row
+        # that is still young enough to stay
+        row = conn.execute(
+            "SELECT id FROM chat_messages WHERE ts >= ? ORDER BY ts LIMIT 1", (cutoff,)
+        ).fetchone() or conn.execute("SELECT MAX(id) + 1 FROM chat_messages").fetchone()
+    upper = row[0]
+    moved = 0
+    while upper is not None:
+        with dbpool.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM chat_messages WHERE id < ? ORDER BY id LIMIT ?",
+                (upper, batch),
+            ).fetchall()
+        if not rows:
+            break
+        archive.store(rows)
+        first, last = rows[0][0], rows[-1][0]
+        writer.run(lambda conn: conn.execute(
+            "DELETE FROM chat_messages WHERE id >= ? AND id <= ?", (first, last)
+        ))
+        recent.discard_before(last + 1)
+        moved += len(rows)
+    return moved
+
+
+def archive_loop():
+    while True:
+        socketio.sleep(ARCHIVE_INTERVAL)
+        # a failed pass leaves the rows in app.db for the next one
+        try:
+            archive_old_messages()
+        except Exception as e:
+            print(f"archive pass failed: {e!r}")
+
+
+def start_archive_task():
+    global archive_task
+    if archive_task is None and ARCHIVE_INTERVAL > 0:
+        archive_task = socketio.start_background_task(archive_loop)
+
+
+def maintenance_loop():
+    while True:
+        try:
+            pause = maintenance.tick()
+        except Exception as e:
+            print(f"maintenance failed: {e!r}")
+            pause = MAINT_TICK
+        socketio.sleep(pause)
+
+
+def start_maintenance_task():
+    global maintenance_task
+    if maintenance_task is None:
+        maintenance_task = socketio.start_background_task(maintenance_loop)
+
+
+def message_id_of(data):
+    return parse_id(data.get('message_id')) if isinstance(data, dict) else None
+
+
+def set_like(username, message_id, liked):
+    if liked:
+        sql = """
+            INSERT OR IGNORE INTO likes (message_id, user)
+            SELECT ?, ? WHERE EXISTS (SELECT 1 FROM chat_messages WHERE id = ?)
+        """
+        params = (message_id, username, message_id)
+    else:
+        sql = "DELETE FROM likes WHERE message_id = ? AND user = ?"
+        params = (message_id, username)
+    # the counter triggers keep message_counters in step
+    if writer.run(lambda conn: conn.execute(sql, params).rowcount):
+        with pending_likes_lock:
+            pending_likes.add(message_id)
+
+
+def take_like_counts():
+    # {room: [[message_id, likes], ...]} for messages liked since the last call
+    with pending_likes_lock:
+        ids = list(pending_likes)
+        pending_likes.clear()
+    if not ids:
+        return {}
+    with dbpool.connection() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT m.id, m.room, IFNULL(c.likes, 0) FROM chat_messages m
+            LEFT JOIN message_counters c ON c.message_id = m.id
+            WHERE m.id IN ({", ".join("?" * len(ids))})
             """,
-            (f'%{query}%', f'%{query}%'),
+            ids,
+        ).fetchall()
+    by_room = {}
+    for message_id, room, likes in rows:
+        by_room.setdefault(room, []).append([message_id, likes])
+    return by_room
+
+
+def likes_loop():
+    while True:
+        socketio.sleep(LIKE_WINDOW)
+        try:
+            for room, likes in take_like_counts().items():
+                safe_emit('message_likes', {'likes': likes}, to=room_channel(room))
+        except Exception as e:
+            print(f"like broadcast failed: {e!r}")
+
+
+def start_likes_task():
+    global likes_task
+    if likes_task is None:
+        likes_task = socketio.start_background_task(likes_loop)
+
+
+def add_comment(username, message_id, text):
+    # (room, comment), or None when the message doesn't exist
+    def job(conn):
+        row = conn.execute("SELECT room FROM chat_messages WHERE id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None
+        cursor = conn.execute(
+            "INSERT INTO comments (message_id, user, text) VALUES (?, ?, ?)",
+            (message_id, username, text),
         )
-        rows = c.fetchall()
-        results = [
-            {
-                "user": r[0],
-                "message": r[1],
-                "image": r[2],
-                "file": r[3],
-                "file_name": r[4],
-                "file_type": r[5],
-                "fileName": r[4],
-                "fileType": r[5],
-                "timestamp": r[6],
-            }
-            for r in rows
-        ]
-    emit('chat_search_results', results)
+        return row[0], cursor.lastrowid
+
+    result = writer.run(job)
+    if result is None:
+        return None
+    room, comment_id = result
+    comment = {
+        'id': comment_id,
+        'message_id': message_id,
+        'user': username,
+        'text': text,
+        'ts': int(time.time() * 1000),
+    }
+    return room, comment
+
+
+def reactions(message_ids):
+    # like/comment counts and the comments themselves for one page of
+    # messages, fetched by the client after the page arrives
+    if not isinstance(message_ids, list):
+        return {'counts': [], 'comments': []}
+    ids = [i for i in map(parse_id, message_ids[:HISTORY_MAX_PAGE_SIZE]) if i is not None]
+    if not ids:
+        return {'counts': [], 'comments': []}
+    marks = ", ".join("?" * len(ids))
+    with dbpool.connection() as conn:
+        counts = conn.execute(
+            f"""
+            SELECT message_id, likes, comments FROM message_counters
+            WHERE message_id IN ({marks}) AND (likes > 0 OR comments > 0)
+            """,
+            ids,
+        ).fetchall()
+        commented = [c[0] for c in counts if c[2] > 0]
+        comments = []
+        if commented:
+            comments = conn.execute(
+                f"""
+                SELECT id, message_id, user, text,
+                       CAST(strftime('%s', timestamp) AS INTEGER) * 1000
+                FROM comments WHERE message_id IN ({", ".join("?" * len(commented))})
+                ORDER BY message_id, id
+                """,
+                commented,
+            ).fetchall()
+    return {
+        'counts': [list(c) for c in counts],
+        'comments': [
+            {'id': c[0], 'message_id': c[1], 'user': c[2], 'text': c[3], 'ts': c[4]}
+            for c in comments
+        ],
+    }
+
+
+@socketio.on('like_message')
+def like_message(data=None):
+    message_id = message_id_of(data)
+    if message_id is None or not current_user.is_authenticated:
+        return
+    set_like(current_user.username, message_id, True)
+    start_likes_task()
+
+
+@socketio.on('unlike_message')
+def unlike_message(data=None):
+    message_id = message_id_of(data)
+    if message_id is None or not current_user.is_authenticated:
+        return
+    set_like(current_user.username, message_id, False)
+    start_likes_task()
+
+
+@socketio.on('comment_message')
+def comment_message(data=None):
+    message_id = message_id_of(data)
+    text = (data.get('text') or '').strip()[:COMMENT_MAX_LEN] if isinstance(data, dict) else ''
+    if message_id is None or not text:
+        return
+    if not current_user.is_authenticated:
+        emit('chat_error', 'Login required to comment.')
+        return
+    result = add_comment(current_user.username, message_id, text)
+    if result is not None:
+        room, comment = result
+        safe_emit('message_comment', comment, to=room_channel(room))
+
+
+@socketio.on('get_reactions')
+def get_reactions(data=None):
+    # answered through the ack
+    return reactions(data.get('message_ids') if isinstance(data, dict) else None)
 
 
 @socketio.on('user_ping')
 def handle_user_ping():
     if current_user.is_authenticated:
-        active_users[current_user.username] = time.time()
+        presence.touch(current_user.username)
         sid_to_user[request.sid] = current_user.username
-        safe_emit('active_user_update', {
-            'users': get_active_users(),
-            'count': len(get_active_users())
-        })
 
 
 @socketio.event
 def disconnect():
     sid = request.sid
     print(f"Client {sid} disconnected")
+    client_wire.pop(sid, None)
+    client_room.pop(sid, None)
     user = sid_to_user.pop(sid, None)
-    if user and user in active_users:
-        active_users.pop(user, None)
-        safe_emit('active_user_update', {
-            'users': get_active_users(),
-            'count': len(get_active_users())
-        })
+    if user:
+        presence.remove(user)
 
 
 if __name__ == '__main__':
-    socketio.run(app)
+    start_maintenance_task()
+    socketio.run(
+        app,
+        host=os.environ.get("HOST", "127.0.0.1"),
+        port=int(os.environ.get("PORT", 5000)),
+    )
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Tiered retention for chat_messages. Messages older than ARCHIVE_AFTER_DAYS
+# move out of the hot app.db into one SQLite file per month under ARCHIVE_DIR
+# (chat-YYYY-MM.db), with inline image/file payloads zlib-compressed; stored
+# blobs stay in the blob store and are still referenced by hash. Rows are
+# archived strictly in id order, so every archived id is below every hot id
+# and history paging carries on into the archives where the hot table ends.
+#
+#   python archive.py [--days N]     # one pass; app.py also runs it hourly
+#
+# Each month is its own database rather than an ATTACHed schema: SQLite caps
+# attachments at ten per connection, well short of years of months, and a
+# lookup usually touches only the newest one or two files anyway.
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from contextlib import closing
+
+from db import DB_PATH, has_search_index
+
+ARCHIVE_DIR = os.environ.get(
+    "ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive")
+)
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", 90))
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH", 500))
+ARCHIVE_COMPRESS_LEVEL = int(os.environ.get("ARCHIVE_COMPRESS_LEVEL", 6))
+ARCHIVE_NAME_RE = re.compile(r"^chat-(\d{4}-\d{2})\.db$")
+# inline attachment columns, stored compressed
+COMPRESSED = ("image", "file")
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_messages (
+  id        INTEGER PRIMARY KEY,
+  user      TEXT,
+  message   TEXT,
+  image     BLOB,
+  file      BLOB,
+  file_name TEXT,
+  file_type TEXT,
+  timestamp DATETIME,
+  blob_hash TEXT,
+  blob_size INTEGER,
+  blob_type TEXT,
+  ts        INTEGER,
+  room      TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_chat_messages_room ON chat_messages(room, id);
+CREATE INDEX IF NOT EXISTS idx_chat_messages_blob_hash ON chat_messages(blob_hash);
+"""
+ARCHIVE_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+  message, user, file_name,
+  content='chat_messages', content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+
+def deflate(value):
+    if value is None:
+        return None
+    return zlib.compress(value.encode() if isinstance(value, str) else value,
+                         ARCHIVE_COMPRESS_LEVEL)
+
+
+def inflate(value):
+    return zlib.decompress(value).decode() if isinstance(value, bytes) else value
+
+
+def select_list(fields, prefix=""):
+    return ", ".join(
+        f"inflate({prefix}{f}) AS {f}" if f in COMPRESSED else f"{prefix}{f}" for f in fields
+    )
+
+
+def month_of(ts):
+    return time.strftime("%Y-%m", time.gmtime(ts / 1000))
+
+
+class Archive:
+    # The monthly archive files of one hot database. `fields` is the hot
+    # column order (app.MESSAGE_FIELDS); rows come back in that order with
+    # attachments already inflated, so callers can't tell archived rows from
+    # hot ones. Which rooms each month holds is cached per file mtime, so a
+    # room with nothing archived doesn't open every file on each lookup.
+
+    def __init__(self, fields, directory=ARCHIVE_DIR):
+        self.fields = fields
+        self.directory = directory
+        self.columns = select_list(fields)
+        self.ts_index = fields.index("ts")
+        self.lock = threading.Lock()
+        self.room_cache = {}
+
+    def path(self, month):
+        return os.path.join(self.directory, f"chat-{month}.db")
+
+    def months(self):
+        # newest first
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((m.group(1) for m in map(ARCHIVE_NAME_RE.match, names) if m), reverse=True)
+
+    def connect(self, month):
+        conn = sqlite3.connect(f"file:{self.path(month)}?mode=ro", uri=True, check_same_thread=False)
+        conn.create_function("inflate", 1, inflate, deterministic=True)
+        return conn
+
+    def rooms(self, month):
+        try:
+            mtime = os.stat(self.path(month)).st_mtime_ns
+        except FileNotFoundError:
+            return frozenset()
+        with self.lock:
+            cached = self.room_cache.get(month)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with closing(self.connect(month)) as conn:
+            rooms = frozenset(r[0] for r in conn.execute("SELECT DISTINCT room FROM chat_messages"))
+        with self.lock:
+            self.room_cache[month] = (mtime, rooms)
+        return rooms
+
+    def months_with(self, room):
+        return [m for m in self.months() if room in self.rooms(m)]
+
+    def store(self, rows):
+        # write rows (in hot column order, ascending id) to their month files
+        # and make them durable; re-storing a row is a no-op. A row never
+        # lands in an earlier month than the row before it, so each file
+        # holds one contiguous id range even where ts and id disagree.
+        os.makedirs(self.directory, exist_ok=True)
+        months = self.months()
+        floor = months[0] if months else ""
+        by_month = {}
+        for row in rows:
+            floor = max(floor, month_of(row[self.ts_index] or 0))
+            by_month.setdefault(floor, []).append(row)
+        marks = ", ".join("?" * len(self.fields))
+        compressed = [i for i, f in enumerate(self.fields) if f in COMPRESSED]
+        for month, month_rows in by_month.items():
+            with closing(sqlite3.connect(self.path(month))) as conn:
+                conn.execute("PRAGMA synchronous=FULL")
+                conn.executescript(ARCHIVE_SCHEMA)
+                try:
+                    conn.executescript(ARCHIVE_FTS_SCHEMA)
+                    fts = True
+                except sqlite3.OperationalError:
+                    fts = False
+                with conn:
+                    for row in month_rows:
+                        row = list(row)
+                        for i in compressed:
+                            row[i] = deflate(row[i])
+                        cursor = conn.execute(
+                            f"INSERT OR IGNORE INTO chat_messages ({', '.join(self.fields)}) "
+                            f"VALUES ({marks})",
+                            row,
+                        )
+                        if fts and cursor.rowcount:
+                            conn.execute(
+                                """
+                                INSERT INTO chat_messages_fts(rowid, message, user, file_name)
+                                SELECT id, message, user, file_name FROM chat_messages WHERE id = ?
+                                """,
+                                (row[0],),
+                            )
+
+    def page(self, before_id, limit, room=None):
+        # (rows, has_more): up to `limit` of the room's archived rows below
+        # before_id, ascending
+        found = []
+        has_more = False
+        for month in self.months_with(room):
+            with closing(self.connect(month)) as conn:
+                clauses, params = "room IS ?", (room,)
+                if before_id is not None:
+                    clauses, params = clauses + " AND id < ?", params + (before_id,)
+                rows = conn.execute(
+                    f"SELECT {self.columns} FROM chat_messages WHERE {clauses} "
+                    "ORDER BY id DESC LIMIT ?",
+                    params + (limit - len(found) + 1,),
+                ).fetchall()
+            if len(found) == limit:
+                has_more = bool(rows)
+            else:
+                has_more = len(rows) > limit - len(found)
+                found.extend(rows[:limit - len(found)])
+            if has_more:
+                break
+            if found:
+                before_id = found[-1][0]
+        found.reverse()
+        return found, has_more
+
+    def search(self, match, like, limit, room=None):
+        # newest months first; `match` is an FTS5 query, `like` a LIKE
+        # pattern for archives written without FTS5
+        found = []
+        for month in self.months_with(room):
+            if len(found) >= limit:
+                break
+            with closing(self.connect(month)) as conn:
+                if has_search_index(conn):
+                    rows = conn.execute(
+                        f"""
+                        SELECT {select_list(self.fields, "m.")} FROM chat_messages_fts
+                        JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+                        WHERE chat_messages_fts MATCH ? AND m.room IS ?
+                        ORDER BY chat_messages_fts.rank LIMIT ?
+                        """,
+                        (match, room, limit - len(found)),
+                    )
+                else:
+                    rows = conn.execute(
+                        f"""
+                        SELECT {self.columns} FROM chat_messages
+                        WHERE room IS ? AND (message LIKE ? OR user LIKE ?)
+                        ORDER BY id DESC LIMIT ?
+                        """,
+                        (room, like, like, limit - len(found)),
+                    )
+                found.extend(rows.fetchall())
+        return found
+
+    def blob_type(self, digest):
+        for month in self.months():
+            with closing(self.connect(month)) as conn:
+                row = conn.execute(
+                    "SELECT blob_type FROM chat_messages WHERE blob_hash = ? LIMIT 1", (digest,)
+                ).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS)
+    args = parser.parse_args(argv[1:])
+    import app
+
+    moved = app.archive_old_messages(args.days)
+    print(f"archived {moved} messages into {app.archive.directory}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
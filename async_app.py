@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# asyncio server mode: the same chat protocol as app.py, served by a
+# python-socketio AsyncServer under an ASGI server (uvicorn). Handlers never
+# touch SQLite or the disk themselves; that work runs on a bounded thread
+# pool (ASYNC_DB_THREADS) and handlers await it, so a long history page or
+# search only occupies one pool thread while every other socket keeps being
+# served. HTTP routes (/blobs/...) are still the Flask app's, mounted through
+# asgiref.
+#
+#   python async_app.py            # or: uvicorn async_app:asgi_app
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio
+from asgiref.wsgi import WsgiToAsgi
+from flask_login import current_user
+
+import app as chat
+import uploads
+import wire
+
+ASYNC_DB_THREADS = int(os.environ.get("ASYNC_DB_THREADS", 8))
+
+db_executor = ThreadPoolExecutor(ASYNC_DB_THREADS, thread_name_prefix="chat-db")
+
+if chat.SOCKETIO_MESSAGE_QUEUE:
+    # the queue must be redis-compatible here; Flask workers and async
+    # workers can share it
+    client_manager = socketio.AsyncRedisManager(chat.SOCKETIO_MESSAGE_QUEUE)
+else:
+    client_manager = None
+sio = socketio.AsyncServer(async_mode='asgi', json=wire, client_manager=client_manager)
+asgi_app = socketio.ASGIApp(sio, other_asgi_app=WsgiToAsgi(chat.app))
+presence_task = None
+likes_task = None
+archive_task = None
+maintenance_task = None
+
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def emit_events(events, to):
+    # advance one of app.py's *_events generators on a pool thread a chunk
+    # at a time, emitting in between so large results stay streamed
+    step = None
+    try:
+        while True:
+            step = db_executor.submit(next, events, None)
+            item = await asyncio.wrap_future(step)
+            if item is None:
+                return
+            event, data = item
+            await sio.emit(event, data, to=to)
+    finally:
+        if step is not None and not step.done():
+            # cancelled while next() still runs on its thread; a generator
+            # can't be closed mid-step, so close it there once it returns
+            step.add_done_callback(lambda _: events.close())
+        else:
+            await run_db(events.close)
+
+
+def load_user(environ):
+    # whatever Flask-Login setup the Flask app has, applied to the
+    # handshake's cookies; None without one or when the lookup fails
+    if getattr(chat.app, 'login_manager', None) is None:
+        return None
+    cookie = environ.get('HTTP_COOKIE', '')
+    try:
+        with chat.app.test_request_context('/', headers={'Cookie': cookie}):
+            if not current_user.is_authenticated:
+                return None
+            return getattr(current_user, 'username', None)
+    except Exception as e:
+        print(f'load_user failed: {e!r}')
+        return None
+
+
+async def presence_loop():
+    while True:
+        await asyncio.sleep(chat.PRESENCE_WINDOW)
+        try:
+            await run_db(chat.presence.expire)
+            delta = await run_db(chat.presence.take_delta)
+            if delta is not None:
+                await sio.emit('presence_delta', delta, to=chat.PRESENCE_DELTA_ROOM)
+                snapshot = await run_db(chat.presence.snapshot)
+                await sio.emit('active_user_update', snapshot, to=chat.PRESENCE_LIST_ROOM)
+        except Exception as e:
+            print(f'presence update failed: {e!r}')
+
+
+def start_presence_task():
+    global presence_task
+    if presence_task is None:
+        presence_task = sio.start_background_task(presence_loop)
+
+
+async def likes_loop():
+    while True:
+        await asyncio.sleep(chat.LIKE_WINDOW)
+        try:
+            for room, likes in (await run_db(chat.take_like_counts)).items():
+                await sio.emit('message_likes', {'likes': likes}, to=chat.room_channel(room))
+        except Exception as e:
+            print(f'like broadcast failed: {e!r}')
+
+
+def start_likes_task():
+    global likes_task
+    if likes_task is None:
+        likes_task = sio.start_background_task(likes_loop)
+
+
+async def archive_loop():
+    while True:
+        await asyncio.sleep(chat.ARCHIVE_INTERVAL)
+        try:
+            await run_db(chat.archive_old_messages)
+        except Exception as e:
+            print(f'archive pass failed: {e!r}')
+
+
+def start_archive_task():
+    global archive_task
+    if archive_task is None and chat.ARCHIVE_INTERVAL > 0:
+        archive_task = sio.start_background_task(archive_loop)
+
+
+async def maintenance_loop():
+    while True:
+        try:
+            pause = await run_db(chat.maintenance.tick)
+        except Exception as e:
+            print(f'maintenance failed: {e!r}')
+            pause = chat.MAINT_TICK
+        await asyncio.sleep(pause)
+
+
+def start_maintenance_task():
+    global maintenance_task
+    if maintenance_task is None:
+        maintenance_task = sio.start_background_task(maintenance_loop)
+
+
+async def username(sid):
+    return (await sio.get_session(sid)).get('user')
+
+
+async def enter_chat_room(sid, room):
+    leave, join = chat.switch_chat_room(sid, room)
+    if leave == join:
+        return
+    if leave is not None:
+        await sio.leave_room(sid, leave)
+    await sio.enter_room(sid, join)
+
+
+async def room_history(sid, room):
+    if sid in chat.client_wire:
+        await emit_events(chat.history_events(sid, room=room, reset=True), sid)
+    else:
+        await sio.emit('chat_history', await run_db(chat.fetch_history_page, room=room), to=sid)
+
+
+@sio.on('connect')
+async def chat_connect(sid, environ, auth=None):
+    await sio.save_session(sid, {'user': await run_db(load_user, environ)})
+    room = chat.room_name(auth.get('room')) if isinstance(auth, dict) else None
+    await enter_chat_room(sid, room)
+    if isinstance(auth, dict) and (auth.get('paged') or auth.get('proto')):
+        chat.negotiate_wire(sid, auth)
+        last_id = chat.parse_id(auth.get('last_id'))
+        if last_id is not None:
+            await emit_events(chat.resync_events(sid, last_id, room), sid)
+        else:
+            await emit_events(chat.history_events(sid, room=room), sid)
+    else:
+        await sio.emit('chat_history', await run_db(chat.fetch_history_page, room=room), to=sid)
+    start_presence_task()
+    start_archive_task()
+    start_maintenance_task()
+    mode = auth.get('presence') if isinstance(auth, dict) else None
+    if mode == 'delta':
+        await sio.enter_room(sid, chat.PRESENCE_DELTA_ROOM)
+        await sio.emit('presence_snapshot', await run_db(chat.presence.snapshot), to=sid)
+    elif mode != 'none':
+        await sio.enter_room(sid, chat.PRESENCE_LIST_ROOM)
+        await sio.emit('active_user_update', await run_db(chat.presence.snapshot), to=sid)
+
+
+@sio.on('get_presence')
+async def get_presence(sid):
+    await sio.emit('presence_snapshot', await run_db(chat.presence.snapshot), to=sid)
+
+
+@sio.on('get_chat_history')
+async def get_chat_history(sid, data=None):
+    room = chat.client_room.get(sid)
+    if not isinstance(data, dict):
+        await sio.emit('chat_history', await run_db(chat.fetch_history_page, room=room), to=sid)
+        return
+    if 'proto' in data:
+        chat.negotiate_wire(sid, data)
+    before_id = chat.parse_id(data.get('before_id'))
+    limit = chat.page_limit(data.get('limit'))
+    await emit_events(chat.history_events(sid, before_id, limit, room), sid)
+
+
+@sio.on('resync_chat')
+async def resync_chat(sid, data=None):
+    room = chat.client_room.get(sid)
+    last_id = chat.parse_id(data.get('last_id')) if isinstance(data, dict) else None
+    if last_id is None:
+        await emit_events(chat.history_events(sid, room=room), sid)
+        return
+    await emit_events(chat.resync_events(sid, last_id, room), sid)
+
+
+@sio.on('join_room')
+async def join_chat_room(sid, data=None):
+    room = chat.room_name(data.get('room')) if isinstance(data, dict) else None
+    await enter_chat_room(sid, room)
+    await room_history(sid, room)
+
+
+@sio.on('leave_room')
+async def leave_chat_room(sid, data=None):
+    await enter_chat_room(sid, None)
+    await room_history(sid, None)
+
+
+async def broadcast_message(row):
+    await sio.emit('chat_message', chat.encode_row(row), to=chat.room_channel(row[12]))
+
+
+@sio.on('chat_message')
+async def handle_chat_message(sid, data):
+    fields = chat.read_chat_message(data)
+    if fields is None:
+        return
+    user = await username(sid)
+    if user is None:
+        await sio.emit('chat_error', 'Login required to send messages.', to=sid)
+        return
+    row = await run_db(chat.post_chat_message, user, *fields, room=chat.client_room.get(sid))
+    await broadcast_message(row)
+
+
+async def upload_action(sid, data, action, *args):
+    user = await username(sid)
+    if user is None:
+        return {'error': 'Login required to send messages.'}
+    if not isinstance(data, dict):
+        return {'error': 'Invalid request.'}
+    try:
+        return await run_db(action, user, data, *args)
+    except uploads.UploadError as e:
+        return {'error': str(e)}
+
+
+@sio.on('upload_init')
+async def upload_init(sid, data=None):
+    return await upload_action(sid, data, chat.upload_init)
+
+
+@sio.on('upload_chunk')
+async def upload_chunk(sid, data=None):
+    return await upload_action(sid, data, chat.upload_chunk)
+
+
+@sio.on('upload_status')
+async def upload_status(sid, data=None):
+    return await upload_action(sid, data, chat.upload_status)
+
+
+@sio.on('upload_finish')
+async def upload_finish(sid, data=None):
+    ack = await upload_action(sid, data, chat.finish_upload, chat.client_room.get(sid))
+    if isinstance(ack, dict):
+        return ack
+    await broadcast_message(ack)
+    return {'id': ack[0]}
+
+
+@sio.on('search_chat')
+async def search_chat(sid, data):
+    query = (data.get('query') or '').strip()
+    room = chat.client_room.get(sid)
+    if sid in chat.client_wire:
+        await emit_events(chat.search_events(sid, query, room), sid)
+    else:
+        await sio.emit('chat_search_results', await run_db(chat.search_results, query, room), to=sid)
+
+
+@sio.on('like_message')
+async def like_message(sid, data=None):
+    message_id = chat.message_id_of(data)
+    user = await username(sid)
+    if message_id is None or user is None:
+        return
+    await run_db(chat.set_like, user, message_id, True)
+    start_likes_task()
+
+
+@sio.on('unlike_message')
+async def unlike_message(sid, data=None):
+    message_id = chat.message_id_of(data)
+    user = await username(sid)
+    if message_id is None or user is None:
+        return
+    await run_db(chat.set_like, user, message_id, False)
+    start_likes_task()
+
+
+@sio.on('comment_message')
+async def comment_message(sid, data=None):
+    message_id = chat.message_id_of(data)
+    text = (data.get('text') or '').strip()[:chat.COMMENT_MAX_LEN] if isinstance(data, dict) else ''
+    if message_id is None or not text:
+        return
+    user = await username(sid)
+    if user is None:
+        await sio.emit('chat_error', 'Login required to comment.', to=sid)
+        return
+    result = await run_db(chat.add_comment, user, message_id, text)
+    if result is not None:
+        room, comment = result
+        await sio.emit('message_comment', comment, to=chat.room_channel(room))
+
+
+@sio.on('get_reactions')
+async def get_reactions(sid, data=None):
+    return await run_db(chat.reactions, data.get('message_ids') if isinstance(data, dict) else None)
+
+
+@sio.on('user_ping')
+async def handle_user_ping(sid):
+    user = await username(sid)
+    if user:
+        chat.presence.touch(user)
+        chat.sid_to_user[sid] = user
+
+
+@sio.on('disconnect')
+async def disconnect(sid):
+    chat.client_wire.pop(sid, None)
+    chat.client_room.pop(sid, None)
+    user = chat.sid_to_user.pop(sid, None)
+    if user:
+        chat.presence.remove(user)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(
+        asgi_app,
+        host=os.environ.get("HOST", "127.0.0.1"),
+        port=int(os.environ.get("PORT", 5000)),
+    )
@@ -1,24 +1,280 @@
 #!/usr/bin/env python3
+# Incremental file backups. Every run writes a complete snapshot,
+# backups/<UTC timestamp>/<ext>/<path>, plus a manifest.json holding each
+# file's size, mtime and SHA-256. A file whose size and mtime match the
+# previous snapshot's manifest is hard-linked from that snapshot, not read.
+# Anything else is hashed on a thread pool, and copied only if its content
+# really changed. A snapshot gets its final name only once it is complete.
+#
+# app.db and the archive's monthly files are left out of the file copy and
+# go through a database stage instead: SQLite's online backup API copies each
+# DB_BACKUP_PAGES pages at a time, sleeping DB_BACKUP_SLEEP seconds between
+# steps. Each copy is checked with PRAGMA integrity_check and then stored
+# gzipped, as db/app.db.gz and db/archive/chat-YYYY-MM.db.gz. A month file
+# whose size and mtime haven't moved is hard-linked from the previous
+# snapshot instead.
+#
+#   python backup.py [--dry-run] [--skip-db]
+import argparse
+import gzip
+import hashlib
+import json
 import os
+import re
 import shutil
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from archive import ARCHIVE_DIR, ARCHIVE_NAME_RE
+from db import DB_PATH
 
 BACKUP_ROOT = 'backups'
 EXCLUDE_DIRS = {'.git', 'node_modules', BACKUP_ROOT}
+BACKUP_THREADS = int(os.environ.get('BACKUP_THREADS', 8))
+MANIFEST = 'manifest.json'
+SNAPSHOT_RE = re.compile(r'^\d{8}T\d{12}Z$')
+COPY_CHUNK = 1 << 20
+DB_BACKUP_PAGES = int(os.environ.get('DB_BACKUP_PAGES', 256))
+DB_BACKUP_SLEEP = float(os.environ.get('DB_BACKUP_SLEEP', 0.01))
+DB_BACKUP_LEVEL = int(os.environ.get('DB_BACKUP_LEVEL', 6))
+DB_SUFFIXES = ('', '-wal', '-shm', '-journal')
+DB_FILES = {os.path.abspath(DB_PATH) + suffix for suffix in DB_SUFFIXES}
+
+
+def is_database(path):
+    # the live databases and their journals, which the file copy must not
+    # touch
+    path = os.path.abspath(path)
+    if path in DB_FILES:
+        return True
+    directory, name = os.path.split(path)
+    if directory != os.path.abspath(ARCHIVE_DIR):
+        return False
+    return any(name.endswith(s) and ARCHIVE_NAME_RE.match(name[:len(name) - len(s)])
+               for s in DB_SUFFIXES)
+
+
+def database_files():
+    # (name, path) for app.db and every archive month; name is the copy's
+    # place under db/ and its key in the manifest
+    found = [(os.path.basename(DB_PATH), DB_PATH)] if os.path.exists(DB_PATH) else []
+    try:
+        names = sorted(os.listdir(ARCHIVE_DIR))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if ARCHIVE_NAME_RE.match(name):
+            found.append((f'archive/{name}', os.path.join(ARCHIVE_DIR, name)))
+    return found
+
+
+def dest_path(rel):
+    # snapshots keep one subdirectory per file extension
+    ext = os.path.splitext(rel)[1].lstrip('.') or 'no_ext'
+    return os.path.join(ext, rel)
+
 
-def backup():
-    for root, dirs, files in os.walk('.', topdown=True):
+def scan(top='.'):
+    files = {}
+    for root, dirs, names in os.walk(top, topdown=True):
         dirs[:] = [d for d in dirs if d not in EXCLUDE_DIRS and not d.startswith('.')]
-        for filename in files:
-            src_path = os.path.join(root, filename)
-            ext = os.path.splitext(filename)[1].lstrip('.')
-            if not ext:
-                ext = 'no_ext'
-            rel_dir = os.path.relpath(root, '.')
-            if rel_dir == '.':
-                rel_dir = ''
-            dest_dir = os.path.join(BACKUP_ROOT, ext, rel_dir)
-            os.makedirs(dest_dir, exist_ok=True)
-            shutil.copy2(src_path, os.path.join(dest_dir, filename))
+        for name in names:
+            path = os.path.join(root, name)
+            if is_database(path):
+                continue
+            st = os.stat(path)
+            files[os.path.relpath(path, top)] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return files
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_CHUNK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def copy_file(src, dest):
+    # copy with metadata; returns (sha256, size) of the bytes actually copied
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    h = hashlib.sha256()
+    size = 0
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        for block in iter(lambda: fin.read(COPY_CHUNK), b''):
+            h.update(block)
+            fout.write(block)
+            size += len(block)
+    shutil.copystat(src, dest)
+    return h.hexdigest(), size
+
+
+def link_file(old, dest, src):
+    # unchanged content costs a directory entry; copy when linking fails
+    # (the old snapshot lost the file, another filesystem, ...)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.link(old, dest)
+    except OSError:
+        copy_file(src, dest)
+
+
+def snapshots(root=BACKUP_ROOT):
+    # oldest first
+    if not os.path.isdir(root):
+        return []
+    return sorted(n for n in os.listdir(root) if SNAPSHOT_RE.match(n))
+
+
+def load_manifest(snapshot, key='files'):
+    try:
+        with open(os.path.join(snapshot, MANIFEST)) as f:
+            return json.load(f)[key]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def copy_database(dest, path=DB_PATH):
+    # online backup of path into the plain file dest, checked with
+    # integrity_check; returns (steps, seconds). Holding a read transaction
+    # on the source pins one snapshot for the whole copy: in WAL mode
+    # writers carry on regardless, and the backup never restarts because a
+    # page changed between steps.
+    src = sqlite3.connect(f'file:{path}?mode=ro', uri=True, isolation_level=None)
+    dst = sqlite3.connect(dest)
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        if remaining:
+            time.sleep(DB_BACKUP_SLEEP)
+
+    try:
+        start = time.monotonic()
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        src.backup(dst, pages=DB_BACKUP_PAGES, progress=progress)
+        src.execute('COMMIT')
+        elapsed = time.monotonic() - start
+        # a copy that is not in WAL mode is one self-contained file
+        dst.execute('PRAGMA journal_mode=DELETE')
+        check = [r[0] for r in dst.execute('PRAGMA integrity_check')]
+        if check != ['ok']:
+            raise RuntimeError(f'{path}: backup failed integrity_check: {check[:5]}')
+    finally:
+        dst.close()
+        src.close()
+    return steps, elapsed
+
+
+def backup_database(dest, path=DB_PATH):
+    # copy_database, then gzip into dest.gz; returns its manifest entry
+    tmp = dest + '.tmp'
+    steps, elapsed = copy_database(tmp, path)
+    h = hashlib.sha256()
+    size = 0
+    with open(tmp, 'rb') as fin, gzip.open(dest + '.gz', 'wb', DB_BACKUP_LEVEL) as fout:
+        for block in iter(lambda: fin.read(COPY_CHUNK), b''):
+            h.update(block)
+            fout.write(block)
+            size += len(block)
+    os.unlink(tmp)
+    return {
+        'file': os.path.basename(dest) + '.gz',
+        'size': size,
+        'sha256': h.hexdigest(),
+        'steps': steps,
+        'seconds': round(elapsed, 3),
+        'integrity_check': 'ok',
+    }
+
+
+def backup(dry_run=False, top='.', skip_db=False):
+    names = snapshots()
+    previous_dir = os.path.join(BACKUP_ROOT, names[-1]) if names else None
+    previous = load_manifest(previous_dir) if previous_dir else {}
+    previous_dbs = load_manifest(previous_dir, 'databases') if previous_dir else {}
+    files = scan(top)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    work = os.path.join(BACKUP_ROOT, f'.tmp-{stamp}')
+
+    def process(rel):
+        # True if rel's content changed since the previous snapshot
+        entry = files[rel]
+        old = previous.get(rel)
+        src = os.path.join(top, rel)
+        if old and (old['size'], old['mtime_ns']) == (entry['size'], entry['mtime_ns']):
+            entry['sha256'] = old['sha256']
+        else:
+            entry['sha256'] = file_hash(src)
+        dest = os.path.join(work, dest_path(rel))
+        if old and old['sha256'] == entry['sha256']:
+            if not dry_run:
+                link_file(os.path.join(previous_dir, dest_path(rel)), dest, src)
+            return False
+        if not dry_run:
+            # the file may have moved on since it was hashed; record what
+            # was actually copied
+            entry['sha256'], entry['size'] = copy_file(src, dest)
+        return True
+
+    with ThreadPoolExecutor(BACKUP_THREADS) as pool:
+        changed = [rel for rel, c in zip(files, pool.map(process, files)) if c]
+    changed_bytes = sum(files[rel]['size'] for rel in changed)
+    dbs = [] if skip_db else database_files()
+    if dry_run:
+        print(f'{len(changed)} changed files, {changed_bytes} bytes to copy '
+              f'({len(files) - len(changed)} unchanged)')
+        for name, path in dbs:
+            print(f'database stage: {path} ({os.path.getsize(path)} bytes)')
+        return None
+    databases = {}
+    for name, path in dbs:
+        dest = os.path.join(work, 'db', name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        st = os.stat(path)
+        old = previous_dbs.get(name)
+        # app.db's mtime says nothing about what is still in its WAL; a
+        # month file is rewritten in place, so an unchanged one can be linked
+        if path != DB_PATH and old and (old.get('source_size'), old.get('mtime_ns')) == (
+            st.st_size, st.st_mtime_ns
+        ):
+            try:
+                os.link(os.path.join(previous_dir, 'db', old['file']), dest + '.gz')
+                databases[name] = old
+                continue
+            except OSError:
+                pass
+        entry = backup_database(dest, path)
+        databases[name] = dict(entry, file=f'{name}.gz', source_size=st.st_size,
+                               mtime_ns=st.st_mtime_ns)
+        print(f'{path}: {entry["size"]} bytes in {entry["steps"]} '
+              f'steps, {entry["seconds"]} s, integrity ok')
+    os.makedirs(work, exist_ok=True)
+    with open(os.path.join(work, MANIFEST), 'w') as f:
+        json.dump({'created': stamp, 'files': files, 'databases': databases}, f,
+                  indent=1, sort_keys=True)
+    final = os.path.join(BACKUP_ROOT, stamp)
+    os.rename(work, final)
+    print(f'{final}: copied {len(changed)} changed files ({changed_bytes} bytes), '
+          f'linked {len(files) - len(changed)} unchanged')
+    return final
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report how many files and bytes changed')
+    parser.add_argument('--skip-db', action='store_true',
+                        help='leave out the database stage')
+    args = parser.parse_args(argv[1:])
+    backup(args.dry_run, skip_db=args.skip_db)
+    return 0
+
 
 if __name__ == '__main__':
-    backup()
+    sys.exit(main(sys.argv))
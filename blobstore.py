@@ -0,0 +1,153 @@
+import base64
+import hashlib
+import os
+import re
+import tempfile
+from urllib.parse import unquote_to_bytes
+
+from db import DB_PATH, get_meta, set_meta
+
+BLOB_DIR = os.environ.get(
+    "BLOB_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "blobs")
+)
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URL_RE = re.compile(r"^data:([^;,]*)((?:;[^;,]*)*),", re.S)
+# served inline from /blobs; anything else (HTML, SVG, scripts, ...) is only
+# ever downloaded, since it would run on the chat's own origin
+INLINE_TYPES = frozenset({
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/avif", "image/bmp",
+    "video/mp4", "video/webm", "video/ogg",
+    "audio/mpeg", "audio/ogg", "audio/wav", "audio/webm", "audio/mp4", "audio/aac",
+    "audio/flac",
+})
+
+
+def is_digest(value):
+    return bool(value) and bool(DIGEST_RE.match(value))
+
+
+def blob_path(digest):
+    # fan out on the first two hex characters to keep directories small
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+MIME_RE = re.compile(r"^[a-z0-9][a-z0-9!#$&^_.+-]*/[a-z0-9][a-z0-9!#$&^_.+-]*$")
+
+
+def normalize_type(mime):
+    # the bare, lower-cased type/subtype of a client-declared MIME type;
+    # parameters are dropped and anything malformed becomes octet-stream
+    if not isinstance(mime, str):
+        return "application/octet-stream"
+    mime = mime.split(";", 1)[0].strip().lower()
+    return mime if MIME_RE.match(mime) and len(mime) <= 127 else "application/octet-stream"
+
+
+def is_inline(mime):
+    return mime in INLINE_TYPES
+
+
+def blob_url(digest):
+    return f"/blobs/{digest}"
+
+
+def put_bytes(data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if os.path.exists(path):
+        return digest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # identical concurrent uploads race harmlessly: same name, same bytes
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return digest
+
+
+def put_file(src, chunk_size=1 << 20):
+    # adopt a finished temp file (e.g. a completed upload) without reading it
+    # into memory; src is consumed
+    h = hashlib.sha256()
+    size = 0
+    with open(src, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+            size += len(block)
+    digest = h.hexdigest()
+    path = blob_path(digest)
+    if os.path.exists(path):
+        os.unlink(src)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src, path)
+    return digest, size
+
+
+def parse_data_url(value):
+    if not isinstance(value, str):
+        return None
+    m = DATA_URL_RE.match(value)
+    if not m:
+        return None
+    mime = m.group(1) or "application/octet-stream"
+    payload = value[m.end():]
+    try:
+        if ";base64" in m.group(2):
+            data = base64.b64decode(payload, validate=False)
+        else:
+            data = unquote_to_bytes(payload)
+    except ValueError:
+        return None
+    return data, mime
+
+
+def put_data_url(value):
+    # returns (digest, size, mime), or None when value is not a data URL
+    parsed = parse_data_url(value)
+    if parsed is None:
+        return None
+    data, mime = parsed
+    return put_bytes(data), len(data), normalize_type(mime)
+
+
+def externalize_attachments(conn, batch=100):
+    # move inline data URLs out of chat_messages into the blob store, in
+    # batches. Progress is kept in app_meta so each row is only scanned once
+    # even though the Node server keeps writing inline attachments
+    last_id = int(get_meta(conn, "blob_externalized_id", 0))
+    top = conn.execute("SELECT MAX(id) FROM chat_messages").fetchone()[0] or 0
+    moved = 0
+    while last_id < top:
+        rows = conn.execute(
+            """
+            SELECT id, image, file FROM chat_messages
+            WHERE id > ? AND id <= ?
+            ORDER BY id LIMIT ?
+            """,
+            (last_id, top, batch),
+        ).fetchall()
+        if not rows:
+            last_id = top
+        for row_id, image, file in rows:
+            last_id = row_id
+            blob = put_data_url(image or file)
+            if blob is None:
+                continue
+            conn.execute(
+                """
+                UPDATE chat_messages
+                SET blob_hash=?, blob_size=?, blob_type=?, image=NULL, file=NULL
+                WHERE id=?
+                """,
+                (*blob, row_id),
+            )
+            moved += 1
+        set_meta(conn, "blob_externalized_id", last_id)
+        conn.commit()
+    return moved
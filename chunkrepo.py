@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# Deduplicating backup repository, an alternative to backup.py's snapshot
+# directories. Files are split into content-defined chunks (a gear rolling
+# hash picks the boundaries, so an insert only changes the chunks around
+# it). Each unique chunk is stored once, zlib-compressed, under
+# chunks/<2 hex>/<sha256>. A snapshot is a small gzipped JSON index,
+# snapshots/<timestamp>.json.gz, listing every file's chunk digests. Storage
+# grows with new content, not with the number of runs: near-identical copies
+# in the tree and unchanged files share chunks. app.db and the archive's
+# month files go through backup.py's online copy first. They are cut into
+# fixed CHUNK_DB_SIZE pieces: SQLite pages never shift, so unchanged pages
+# dedupe without running the (pure Python, a few MB/s) rolling hash over the
+# whole database.
+#
+#   python chunkrepo.py backup [--skip-db]
+#   python chunkrepo.py list
+#   python chunkrepo.py restore <snapshot|latest> <dest> [--path PREFIX]
+#   python chunkrepo.py verify [<snapshot|latest>]
+#
+# restore and verify stream one chunk at a time and check every chunk and
+# every file against its SHA-256.
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import zlib
+from datetime import datetime, timezone
+
+from backup import BACKUP_ROOT, COPY_CHUNK, DB_PATH, copy_database, database_files, scan
+
+BACKUP_REPO = os.environ.get('BACKUP_REPO', os.path.join(BACKUP_ROOT, 'repo'))
+CHUNK_MIN = int(os.environ.get('CHUNK_MIN', 2 * 1024))
+CHUNK_AVG_BITS = int(os.environ.get('CHUNK_AVG_BITS', 13))  # 8 KB average
+CHUNK_MAX = int(os.environ.get('CHUNK_MAX', 64 * 1024))
+CHUNK_DB_SIZE = int(os.environ.get('CHUNK_DB_SIZE', 32 * 1024))
+CHUNK_LEVEL = int(os.environ.get('CHUNK_LEVEL', 6))
+SNAPSHOT_RE = re.compile(r'^(\d{8}T\d{12}Z)\.json\.gz$')
+
+MASK64 = (1 << 64) - 1
+# a boundary where the top CHUNK_AVG_BITS bits of the hash are zero; the top
+# bits depend on the last 64 bytes, the low ones only on the last few
+BOUNDARY_MASK = ((1 << CHUNK_AVG_BITS) - 1) << (64 - CHUNK_AVG_BITS)
+# fixed pseudo-random table, so boundaries are the same on every machine
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+class RepoError(Exception):
+    pass
+
+
+def cut_point(data, start, end):
+    # end of the chunk starting at data[start], looking no further than end
+    limit = min(end, start + CHUNK_MAX)
+    if limit - start <= CHUNK_MIN:
+        return limit
+    # nothing before CHUNK_MIN can be a boundary; only warm up the window
+    h = 0
+    for b in data[start + CHUNK_MIN - 64:start + CHUNK_MIN]:
+        h = ((h << 1) + GEAR[b]) & MASK64
+    for i, b in enumerate(data[start + CHUNK_MIN:limit], start + CHUNK_MIN + 1):
+        h = ((h << 1) + GEAR[b]) & MASK64
+        if not h & BOUNDARY_MASK:
+            return i
+    return limit
+
+
+def split(f):
+    # content-defined chunks of the binary stream f
+    buf = b''
+    pos = 0
+    eof = False
+    while True:
+        while not eof and len(buf) - pos < CHUNK_MAX:
+            block = f.read(COPY_CHUNK)
+            if not block:
+                eof = True
+            buf = buf[pos:] + block
+            pos = 0
+        if pos >= len(buf):
+            return
+        end = cut_point(buf, pos, len(buf))
+        yield buf[pos:end]
+        pos = end
+
+
+class Repo:
+    def __init__(self, root=BACKUP_REPO):
+        self.root = root
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def put_chunk(self, data):
+        # store data once; returns (digest, bytes written to disk)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        packed = zlib.compress(data, CHUNK_LEVEL)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(packed)
+        os.replace(tmp, path)
+        return digest, len(packed)
+
+    def get_chunk(self, digest):
+        try:
+            with open(self.chunk_path(digest), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise RepoError(f'chunk {digest}: {e}')
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RepoError(f'chunk {digest}: content does not match its hash')
+        return data
+
+    def snapshots(self):
+        # oldest first
+        try:
+            names = os.listdir(os.path.join(self.root, 'snapshots'))
+        except FileNotFoundError:
+            return []
+        return sorted(m.group(1) for m in map(SNAPSHOT_RE.match, names) if m)
+
+    def resolve(self, name):
+        names = self.snapshots()
+        if name == 'latest':
+            if not names:
+                raise RepoError('the repository has no snapshots')
+            return names[-1]
+        if name not in names:
+            raise RepoError(f'no snapshot {name}')
+        return name
+
+    def load(self, name):
+        path = os.path.join(self.root, 'snapshots', f'{name}.json.gz')
+        with gzip.open(path, 'rt') as f:
+            return json.load(f)
+
+    def save(self, name, index):
+        directory = os.path.join(self.root, 'snapshots')
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt') as f:
+            json.dump(index, f, separators=(',', ':'), sort_keys=True)
+        os.replace(tmp, os.path.join(directory, f'{name}.json.gz'))
+
+    def store_file(self, path, fixed=None):
+        # (entry fields, new bytes on disk) for the file at path, cut into
+        # content-defined chunks or, given `fixed`, pieces of that size
+        h = hashlib.sha256()
+        size = written = 0
+        chunks = []
+        with open(path, 'rb') as f:
+            pieces = iter(lambda: f.read(fixed), b'') if fixed else split(f)
+            for data in pieces:
+                h.update(data)
+                size += len(data)
+                digest, n = self.put_chunk(data)
+                chunks.append(digest)
+                written += n
+        return {'size': size, 'sha256': h.hexdigest(), 'chunks': chunks}, written
+
+    def stream(self, entry):
+        # the file's bytes, one verified chunk at a time
+        for digest in entry['chunks']:
+            yield self.get_chunk(digest)
+
+
+def safe_path(dest, rel):
+    path = os.path.normpath(os.path.join(dest, rel))
+    if os.path.isabs(rel) or os.path.relpath(path, dest).startswith('..'):
+        raise RepoError(f'refusing to restore outside {dest}: {rel}')
+    return path
+
+
+def backup(repo, top='.', skip_db=False):
+    names = repo.snapshots()
+    previous = repo.load(names[-1])['files'] if names else {}
+    files = scan(top)
+    written = 0
+    for rel, entry in files.items():
+        old = previous.get(rel)
+        if old and not old.get('database') and (old['size'], old['mtime_ns']) == (
+            entry['size'], entry['mtime_ns']
+        ):
+            # unchanged since the last snapshot: its chunks are already stored
+            entry.update(sha256=old['sha256'], chunks=old['chunks'], mode=old.get('mode'))
+            continue
+        path = os.path.join(top, rel)
+        stored, n = repo.store_file(path)
+        entry.update(stored, mode=os.stat(path).st_mode & 0o7777)
+        written += n
+    for name, path in [] if skip_db else database_files():
+        rel = os.path.relpath(path, top)
+        if rel.startswith('..'):
+            rel = name
+        st = os.stat(path)
+        old = previous.get(rel)
+        # a month file that hasn't moved keeps its chunks; app.db's mtime
+        # says nothing about its WAL, so it is always copied
+        if path != DB_PATH and old and (old.get('source_size'), old['mtime_ns']) == (
+            st.st_size, st.st_mtime_ns
+        ):
+            files[rel] = old
+            continue
+        fd, tmp = tempfile.mkstemp(dir=repo.root if os.path.isdir(repo.root) else None)
+        os.close(fd)
+        try:
+            copy_database(tmp, path)
+            stored, n = repo.store_file(tmp, CHUNK_DB_SIZE)
+        finally:
+            os.unlink(tmp)
+        files[rel] = dict(stored, mtime_ns=st.st_mtime_ns, mode=st.st_mode & 0o7777,
+                          database=True, source_size=st.st_size)
+        written += n
+    name = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    repo.save(name, {'created': name, 'files': files})
+    total = sum(e['size'] for e in files.values())
+    print(f'snapshot {name}: {len(files)} files, {total} bytes, {written} new bytes stored')
+    return name
+
+
+def restore(repo, name, dest, prefix=''):
+    index = repo.load(repo.resolve(name))
+    restored = 0
+    for rel, entry in sorted(index['files'].items()):
+        if not rel.startswith(prefix):
+            continue
+        path = safe_path(dest, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        h = hashlib.sha256()
+        tmp = path + '.restore'
+        with open(tmp, 'wb') as f:
+            for data in repo.stream(entry):
+                h.update(data)
+                f.write(data)
+        if h.hexdigest() != entry['sha256']:
+            os.unlink(tmp)
+            raise RepoError(f'{rel}: restored content does not match its hash')
+        os.replace(tmp, path)
+        if entry.get('mode') is not None:
+            os.chmod(path, entry['mode'])
+        os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        restored += 1
+    print(f'restored {restored} files from {index["created"]} into {dest}')
+    return restored
+
+
+def verify(repo, names):
+    # every chunk of every file readable and intact, every file hashing to
+    # its recorded digest; returns the problems found
+    problems = []
+    good = set()
+    for name in names:
+        for rel, entry in sorted(repo.load(name)['files'].items()):
+            h = hashlib.sha256()
+            try:
+                for digest, data in zip(entry['chunks'], repo.stream(entry)):
+                    h.update(data)
+                    good.add(digest)
+            except RepoError as e:
+                problems.append(f'{name} {rel}: {e}')
+                continue
+            if h.hexdigest() != entry['sha256']:
+                problems.append(f'{name} {rel}: file hash mismatch')
+    for problem in problems:
+        print('FAIL', problem)
+    print(f'verified {len(names)} snapshots, {len(good)} chunks: '
+          f'{len(problems)} problems')
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repo', default=BACKUP_REPO)
+    commands = parser.add_subparsers(dest='command', required=True)
+    backup_cmd = commands.add_parser('backup')
+    backup_cmd.add_argument('--skip-db', action='store_true')
+    commands.add_parser('list')
+    restore_cmd = commands.add_parser('restore')
+    restore_cmd.add_argument('snapshot')
+    restore_cmd.add_argument('dest')
+    restore_cmd.add_argument('--path', default='', help='only files under this prefix')
+    verify_cmd = commands.add_parser('verify')
+    verify_cmd.add_argument('snapshot', nargs='?', help='default: every snapshot')
+    args = parser.parse_args(argv[1:])
+
+    repo = Repo(args.repo)
+    try:
+        if args.command == 'backup':
+            os.makedirs(repo.root, exist_ok=True)
+            backup(repo, skip_db=args.skip_db)
+        elif args.command == 'list':
+            for name in repo.snapshots():
+                print(name)
+        elif args.command == 'restore':
+            restore(repo, args.snapshot, args.dest, args.path)
+        else:
+            names = [repo.resolve(args.snapshot)] if args.snapshot else repo.snapshots()
+            return 1 if verify(repo, names) else 0
+    except RepoError as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
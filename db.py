@@ -1,7 +1,27 @@
+import argparse
 import os
+import re
 import sqlite3
+import sys
+from contextlib import closing
 
 DB_PATH = os.environ.get("DB_PATH", "app.db")
+# 1 lets init_db run the one-time full VACUUM that switches an existing
+# database to incremental auto_vacuum; otherwise do it offline with
+# `python db.py --convert-auto-vacuum`
+DB_CONVERT_AUTO_VACUUM = os.environ.get("DB_CONVERT_AUTO_VACUUM", "0") == "1"
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Migrations are numbered .sql files in migrations/, applied in order inside
+# a transaction and recorded in PRAGMA user_version, so a warm start is a
+# single pragma read. ws-server/server.js runs the same files. A file may
+# start with directive comments:
+#   -- ensure-column: <table> <column> <definition>   add it if missing
+#   -- requires-column: <table> <column>              skip the body otherwise
+#   -- optional                                       tolerate failure
+MIGRATION_RE = re.compile(r"^(\d+)_[\w-]+\.sql$")
+DIRECTIVE_RE = re.compile(r"^--\s*(ensure-column|requires-column|optional)\b:?\s*(.*)$")
+
 
 def ensure_columns(conn, table, columns):
     c = conn.cursor()
@@ -12,67 +32,168 @@ def ensure_columns(conn, table, columns):
             c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
 
 
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        # chat log
-        c.execute(
-            """
-            CREATE TABLE IF NOT EXISTS chat_messages (
-              id        INTEGER PRIMARY KEY AUTOINCREMENT,
-              user      TEXT,
-              message   TEXT,
-              image     TEXT,
-              file      TEXT,
-              file_name TEXT,
-              file_type TEXT,
-              timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
-        ensure_columns(
-            conn,
-            "chat_messages",
-            {
-                "image": "TEXT",
-                "file": "TEXT",
-                "file_name": "TEXT",
-                "file_type": "TEXT",
-                "timestamp": "DATETIME DEFAULT CURRENT_TIMESTAMP",
-            },
-        )
-        # migrate legacy video column
-        c.execute("PRAGMA table_info(chat_messages)")
-        cols = {row[1] for row in c.fetchall()}
-        if "video" in cols and "file" in cols:
-            c.execute(
-                "UPDATE chat_messages SET file=video WHERE file IS NULL AND video IS NOT NULL"
-            )
-        # comments
-        c.execute(
-            """
-            CREATE TABLE IF NOT EXISTS comments (
-              id         INTEGER PRIMARY KEY AUTOINCREMENT,
-              message_id INTEGER,
-              user       TEXT,
-              comment    TEXT,
-              timestamp  DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
-        # likes
-        c.execute(
-            """
-            CREATE TABLE IF NOT EXISTS likes (
-              id         INTEGER PRIMARY KEY AUTOINCREMENT,
-              message_id INTEGER,
-              user       TEXT,
-              timestamp  DATETIME DEFAULT CURRENT_TIMESTAMP,
-              UNIQUE(message_id, user)
-            )
+def has_column(conn, table, column):
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def load_migrations():
+    migrations = []
+    for name in os.listdir(MIGRATIONS_DIR):
+        m = MIGRATION_RE.match(name)
+        if m:
+            with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                migrations.append((int(m.group(1)), name, f.read()))
+    return sorted(migrations)
+
+
+def parse_directives(sql):
+    directives = []
+    for line in sql.splitlines():
+        m = DIRECTIVE_RE.match(line.strip())
+        if m:
+            directives.append((m.group(1), m.group(2).split(None, 2)))
+    return directives
+
+
+def split_statements(sql):
+    # executescript() would commit our transaction, so run statements one by
+    # one; complete_statement() knows about trigger bodies
+    statements, buf = [], ""
+    for line in sql.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            if buf.strip():
+                statements.append(buf)
+            buf = ""
+    if buf.strip():
+        statements.append(buf)
+    return statements
+
+
+def apply_migration(conn, sql):
+    directives = parse_directives(sql)
+    for kind, args in directives:
+        if kind == "requires-column" and not has_column(conn, *args[:2]):
+            return
+    optional = any(kind == "optional" for kind, _ in directives)
+    conn.execute("SAVEPOINT migration")
+    try:
+        for statement in split_statements(sql):
+            conn.execute(statement)
+        for kind, args in directives:
+            if kind == "ensure-column":
+                table, column, definition = args
+                ensure_columns(conn, table, {column: definition})
+        conn.execute("RELEASE migration")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK TO migration")
+        conn.execute("RELEASE migration")
+        if not optional:
+            raise
+
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    pending = [m for m in load_migrations() if m[0] > version]
+    if not pending:
+        return version
+    isolation, conn.isolation_level = conn.isolation_level, None
+    try:
+        for number, name, sql in pending:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # another process may have migrated while we waited for the lock
+                if conn.execute("PRAGMA user_version").fetchone()[0] < number:
+                    apply_migration(conn, sql)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            version = number
+    finally:
+        conn.isolation_level = isolation
+    return version
+
+
+def has_search_index(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='chat_messages_fts'"
+    ).fetchone() is not None
+
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM app_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(conn, key, value):
+    conn.execute(
+        "INSERT OR REPLACE INTO app_meta (key, value) VALUES (?, ?)", (key, str(value))
+    )
+
+
+def backfill_epoch_ms(conn, batch=5000):
+    # fill chat_messages.ts for rows written before it existed, one short
+    # transaction per id range so live writers are never held up for long
+    until = int(get_meta(conn, "ts_backfill_until", 0))
+    done = int(get_meta(conn, "ts_backfill_id", 0))
+    while done < until:
+        upper = min(done + batch, until)
+        conn.execute(
             """
+            UPDATE chat_messages
+            SET ts = CAST(strftime('%s', timestamp) AS INTEGER) * 1000
+            WHERE id > ? AND id <= ? AND ts IS NULL
+            """,
+            (done, upper),
         )
+        done = upper
+        set_meta(conn, "ts_backfill_id", done)
         conn.commit()
 
-if __name__ == "__main__":
+
+def enable_incremental_vacuum(conn, convert=DB_CONVERT_AUTO_VACUUM):
+    # lets maintenance.py hand free pages back in small incremental_vacuum
+    # steps; True once the database is in that mode. A new database takes
+    # the setting as is. An existing one needs a full VACUUM, which rewrites
+    # the whole file under an exclusive lock, so it only runs when asked to
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return True
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2 and convert:
+        conn.execute("VACUUM")
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+def init_db():
+    with sqlite3.connect(DB_PATH) as conn:
+        enable_incremental_vacuum(conn)
+        migrate(conn)
+        backfill_epoch_ms(conn)
+        # attachments live in the content-addressed blob store; the Node
+        # server still writes inline ones, so pick up anything new
+        from blobstore import externalize_attachments
+
+        externalize_attachments(conn)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--convert-auto-vacuum", action="store_true",
+        help="switch an existing database to incremental auto_vacuum (stop the app first)",
+    )
+    args = parser.parse_args(argv[1:])
+    if args.convert_auto_vacuum:
+        with closing(sqlite3.connect(DB_PATH, isolation_level=None)) as conn:
+            if not enable_incremental_vacuum(conn, convert=True):
+                print(f"{DB_PATH}: could not switch to incremental auto_vacuum", file=sys.stderr)
+                return 1
+        print(f"{DB_PATH}: auto_vacuum=INCREMENTAL")
     init_db()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
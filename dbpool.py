@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from db import DB_PATH
+
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", 256))
+MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))
+
+
+def configure(conn):
+    # WAL lets readers run alongside the writer (including the Node server,
+    # since the journal mode is stored in the database file); NORMAL sync is
+    # durable across app crashes and only fsyncs at checkpoints
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    return conn
+
+
+class ConnectionPool:
+    # Idle connections are reused and each one is used by one thread or
+    # greenlet at a time. Checkout never blocks: when the pool is empty a new
+    # connection is opened, and extras beyond `size` are closed on return.
+    # The pool resets itself after a fork so every worker gets its own.
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.pid = os.getpid()
+        # optional sqlite3 trace callback installed on new connections
+        self.trace = None
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE,
+        )
+        if self.trace is not None:
+            conn.set_trace_callback(self.trace)
+        return configure(conn)
+
+    def acquire(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # inherited from the parent process: never share across fork
+                self.idle = []
+                self.pid = os.getpid()
+            if self.idle:
+                return self.idle.pop()
+        return self._open()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        # same commit/rollback semantics as `with sqlite3.connect(...)`
+        conn = self.acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+pool = ConnectionPool()
+
+
+def connection():
+    return pool.connection()
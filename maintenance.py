@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import time
+
+from db import DB_PATH
+
+# "quiet" means nobody (this process, other workers, the Node server) has
+# committed to app.db for MAINT_QUIET seconds
+MAINT_QUIET = float(os.environ.get("MAINT_QUIET", 5))
+MAINT_TICK = float(os.environ.get("MAINT_TICK", 1.0))
+# a step that needs the write lock waits at most MAINT_BUSY_MS for it and
+# aims to hold it for no more than MAINT_STEP_MS
+MAINT_BUSY_MS = int(os.environ.get("MAINT_BUSY_MS", 20))
+MAINT_STEP_MS = float(os.environ.get("MAINT_STEP_MS", 20))
+MAINT_STEP_PAUSE = float(os.environ.get("MAINT_STEP_PAUSE", 0.2))
+MAINT_CHECKPOINT_INTERVAL = float(os.environ.get("MAINT_CHECKPOINT_INTERVAL", 30))
+MAINT_OPTIMIZE_INTERVAL = float(os.environ.get("MAINT_OPTIMIZE_INTERVAL", 3600))
+MAINT_ANALYSIS_LIMIT = int(os.environ.get("MAINT_ANALYSIS_LIMIT", 400))
+MAINT_VACUUM_MIN_PAGES = int(os.environ.get("MAINT_VACUUM_MIN_PAGES", 256))
+MAINT_VACUUM_MAX_PAGES = int(os.environ.get("MAINT_VACUUM_MAX_PAGES", 4096))
+
+
+class Maintenance:
+    # Housekeeping for app.db, one small step per tick() on a connection of
+    # its own:
+    #  - a PASSIVE WAL checkpoint every MAINT_CHECKPOINT_INTERVAL, which never
+    #    blocks anyone and keeps commits from tripping the autocheckpoint;
+    #    once everything is copied and things are quiet, TRUNCATE shrinks the
+    #    -wal file (cheap then, as there is nothing left to copy)
+    #  - PRAGMA optimize under analysis_limit every MAINT_OPTIMIZE_INTERVAL,
+    #    when quiet
+    #  - incremental_vacuum when quiet and the freelist is large, a few pages
+    #    at a time with the page count tuned so each step takes about
+    #    MAINT_STEP_MS, pausing between steps so writers get in; skipped
+    #    while the database isn't in incremental auto_vacuum mode
+    # Every step is timed; stats maps step name to (runs, total ms, worst ms).
+    # A busy database just skips the step until a later tick.
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self.conn = None
+        self.data_version = None
+        self.changed = time.monotonic()
+        self.next_checkpoint = 0.0
+        self.next_optimize = 0.0
+        self.vacuum_pages = 64
+        self.vacuuming = False
+        self.incremental = None
+        self.stats = {}
+
+    def connect(self):
+        if self.conn is None:
+            # autocommit, so each pragma is its own short transaction
+            self.conn = sqlite3.connect(
+                self.path, timeout=MAINT_BUSY_MS / 1000, isolation_level=None,
+                check_same_thread=False,
+            )
+            self.conn.execute(f"PRAGMA busy_timeout={MAINT_BUSY_MS}")
+            self.conn.execute(f"PRAGMA analysis_limit={MAINT_ANALYSIS_LIMIT}")
+            # converting takes `python db.py --convert-auto-vacuum` and a
+            # restart, so the mode is read once
+            self.incremental = self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        return self.conn
+
+    def step(self, name, sql, script=False):
+        start = time.perf_counter()
+        if script:
+            # the sqlite3 module steps a statement with no result columns
+            # only once, which frees one page of incremental_vacuum(N);
+            # executescript runs it to completion
+            self.conn.executescript(sql)
+            rows = []
+        else:
+            rows = self.conn.execute(sql).fetchall()
+        ms = (time.perf_counter() - start) * 1000
+        runs, total, worst = self.stats.get(name, (0, 0.0, 0.0))
+        self.stats[name] = (runs + 1, total + ms, max(worst, ms))
+        if ms > 5 * MAINT_STEP_MS:
+            print(f"maintenance: {name} took {ms:.0f} ms")
+        return rows, ms
+
+    def quiet(self, now):
+        # data_version moves whenever another connection commits
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            self.data_version = version
+            self.changed = now
+        return now - self.changed >= MAINT_QUIET
+
+    def tick(self):
+        # run at most one step; returns the seconds to wait before the next
+        # tick
+        now = time.monotonic()
+        self.connect()
+        try:
+            quiet = self.quiet(now)
+            if now >= self.next_checkpoint:
+                self.next_checkpoint = now + MAINT_CHECKPOINT_INTERVAL
+                self.checkpoint(quiet)
+            elif quiet and now >= self.next_optimize:
+                self.next_optimize = now + MAINT_OPTIMIZE_INTERVAL
+                self.step("optimize", "PRAGMA optimize")
+            elif quiet and self.incremental and self.vacuum():
+                return MAINT_STEP_PAUSE
+        except sqlite3.OperationalError:
+            # locked by a writer; not quiet after all
+            self.changed = now
+        return MAINT_TICK
+
+    def checkpoint(self, quiet):
+        rows, _ = self.step("checkpoint", "PRAGMA wal_checkpoint(PASSIVE)")
+        busy, log, done = rows[0]
+        if quiet and not busy and log > 0 and log == done:
+            self.step("checkpoint_truncate", "PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def vacuum(self):
+        # one incremental_vacuum step; False when there is nothing worth
+        # reclaiming
+        free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free < (1 if self.vacuuming else MAINT_VACUUM_MIN_PAGES):
+            self.vacuuming = False
+            return False
+        self.vacuuming = True
+        _, ms = self.step("vacuum", f"PRAGMA incremental_vacuum({self.vacuum_pages})", True)
+        if ms > MAINT_STEP_MS:
+            self.vacuum_pages = max(8, self.vacuum_pages // 2)
+        elif ms < MAINT_STEP_MS / 2:
+            self.vacuum_pages = min(MAINT_VACUUM_MAX_PAGES, self.vacuum_pages * 2)
+        return True
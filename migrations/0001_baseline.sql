@@ -0,0 +1,50 @@
+-- Base schema shared by app.py and ws-server/server.js. Databases created
+-- before migrations existed already have these tables in some older shape;
+-- the ensure-column lines add whatever they are missing.
+-- ensure-column: chat_messages room TEXT
+-- ensure-column: chat_messages image TEXT
+-- ensure-column: chat_messages file TEXT
+-- ensure-column: chat_messages file_name TEXT
+-- ensure-column: chat_messages file_type TEXT
+-- ensure-column: chat_messages timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+-- ensure-column: chat_messages blob_hash TEXT
+-- ensure-column: chat_messages blob_size INTEGER
+-- ensure-column: chat_messages blob_type TEXT
+-- ensure-column: comments text TEXT
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+  id        INTEGER PRIMARY KEY AUTOINCREMENT,
+  user      TEXT,
+  room      TEXT,
+  message   TEXT,
+  image     TEXT,
+  file      TEXT,
+  file_name TEXT,
+  file_type TEXT,
+  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+  blob_hash TEXT,
+  blob_size INTEGER,
+  blob_type TEXT
+);
+
+CREATE TABLE IF NOT EXISTS comments (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  message_id INTEGER,
+  user       TEXT,
+  text       TEXT,
+  timestamp  DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS likes (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  message_id INTEGER,
+  user       TEXT,
+  timestamp  DATETIME DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE(message_id, user)
+);
+
+-- small key/value store for backfill progress and similar bookkeeping
+CREATE TABLE IF NOT EXISTS app_meta (
+  key   TEXT PRIMARY KEY,
+  value TEXT
+);
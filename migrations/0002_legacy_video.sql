@@ -0,0 +1,4 @@
+-- Very old databases stored videos in a separate column.
+-- requires-column: chat_messages video
+
+UPDATE chat_messages SET file = video WHERE file IS NULL AND video IS NOT NULL;
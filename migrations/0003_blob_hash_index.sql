@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_chat_messages_blob_hash ON chat_messages(blob_hash);
@@ -0,0 +1,31 @@
+-- FTS5 index over chat text, kept in sync by triggers so writes from either
+-- server are indexed. SQLite builds without FTS5 skip this and search falls
+-- back to LIKE.
+-- optional
+
+CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+  message, user, file_name,
+  content='chat_messages', content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN
+  INSERT INTO chat_messages_fts(rowid, message, user, file_name)
+  VALUES (new.id, new.message, new.user, new.file_name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN
+  INSERT INTO chat_messages_fts(chat_messages_fts, rowid, message, user, file_name)
+  VALUES ('delete', old.id, old.message, old.user, old.file_name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au
+AFTER UPDATE OF message, user, file_name ON chat_messages BEGIN
+  INSERT INTO chat_messages_fts(chat_messages_fts, rowid, message, user, file_name)
+  VALUES ('delete', old.id, old.message, old.user, old.file_name);
+  INSERT INTO chat_messages_fts(rowid, message, user, file_name)
+  VALUES (new.id, new.message, new.user, new.file_name);
+END;
+
+-- backfill rows written before the index existed
+INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild');
@@ -0,0 +1,14 @@
+-- Integer epoch-millisecond timestamps and indexes for the hot access paths.
+-- Both servers set ts on insert; older rows are filled in batches by
+-- db.backfill_epoch_ms up to the id recorded here.
+
+ALTER TABLE chat_messages ADD COLUMN ts INTEGER;
+
+CREATE INDEX IF NOT EXISTS idx_chat_messages_ts ON chat_messages(ts);
+CREATE INDEX IF NOT EXISTS idx_chat_messages_room ON chat_messages(room, id);
+CREATE INDEX IF NOT EXISTS idx_comments_message ON comments(message_id, id);
+-- likes needs no extra index: UNIQUE(message_id, user) already covers
+-- COUNT(*) ... WHERE message_id = ?
+
+INSERT OR REPLACE INTO app_meta (key, value)
+SELECT 'ts_backfill_until', IFNULL(MAX(id), 0) FROM chat_messages;
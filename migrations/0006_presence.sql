@@ -0,0 +1,16 @@
+-- Presence shared by every worker process when app.py runs behind a message
+-- queue. presence holds each active user's expiry deadline (unix seconds);
+-- presence_changes collects users whose membership changed since the last
+-- delta, with whether they were active before.
+
+CREATE TABLE IF NOT EXISTS presence (
+  user     TEXT PRIMARY KEY,
+  deadline REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_presence_deadline ON presence(deadline);
+
+CREATE TABLE IF NOT EXISTS presence_changes (
+  user       TEXT PRIMARY KEY,
+  was_active INTEGER NOT NULL
+);
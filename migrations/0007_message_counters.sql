@@ -0,0 +1,33 @@
+-- Per-message like and comment counts, kept current by triggers so writes
+-- from either server update them and nobody has to COUNT(*) on read.
+
+CREATE TABLE IF NOT EXISTS message_counters (
+  message_id INTEGER PRIMARY KEY,
+  likes      INTEGER NOT NULL DEFAULT 0,
+  comments   INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR REPLACE INTO message_counters (message_id, likes, comments)
+SELECT message_id, SUM(likes), SUM(comments) FROM (
+  SELECT message_id, COUNT(*) AS likes, 0 AS comments FROM likes GROUP BY message_id
+  UNION ALL
+  SELECT message_id, 0, COUNT(*) FROM comments GROUP BY message_id
+) WHERE message_id IS NOT NULL GROUP BY message_id;
+
+CREATE TRIGGER IF NOT EXISTS likes_counter_ai AFTER INSERT ON likes BEGIN
+  INSERT INTO message_counters (message_id, likes) VALUES (new.message_id, 1)
+  ON CONFLICT(message_id) DO UPDATE SET likes = likes + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS likes_counter_ad AFTER DELETE ON likes BEGIN
+  UPDATE message_counters SET likes = likes - 1 WHERE message_id = old.message_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_counter_ai AFTER INSERT ON comments BEGIN
+  INSERT INTO message_counters (message_id, comments) VALUES (new.message_id, 1)
+  ON CONFLICT(message_id) DO UPDATE SET comments = comments + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS comments_counter_ad AFTER DELETE ON comments BEGIN
+  UPDATE message_counters SET comments = comments - 1 WHERE message_id = old.message_id;
+END;
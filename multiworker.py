@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Local check of the multi-worker deployment.
+#
+#   python multiworker.py [--workers N] [--queue URL]
+#
+# Starts N app.py workers on consecutive free ports. They share a scratch
+# database and a message queue, which is a throwaway redis-server when
+# --queue is not given. The check connects one Socket.IO client to each worker
+# and verifies that:
+#  - a broadcast emitted through the queue reaches every client exactly once
+#  - presence changes produce one delta stream that every client sees
+#    identically, and that matches the snapshot each worker reports
+# Needs python-socketio (client) and redis-server or a reachable queue.
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# what `python app.py` runs, on the Werkzeug server, which Flask-SocketIO
+# otherwise refuses outside debug mode
+WORKER = """
+import os
+import app
+app.start_maintenance_task()
+app.socketio.run(app.app, port=int(os.environ["PORT"]), allow_unsafe_werkzeug=True)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+def start_redis(tmp):
+    server = shutil.which("redis-server")
+    if server is None:
+        sys.exit("no --queue given and redis-server is not on PATH")
+    port = free_port()
+    proc = subprocess.Popen(
+        [server, "--port", str(port), "--save", "", "--appendonly", "no", "--dir", tmp],
+        stdout=subprocess.DEVNULL,
+    )
+    wait_port(port)
+    return proc, f"redis://127.0.0.1:{port}/0"
+
+
+class Watcher:
+    # one client per worker, recording the pings and presence it receives
+
+    def __init__(self, port):
+        import socketio
+
+        self.port = port
+        self.lock = threading.Lock()
+        self.pings = []
+        self.versions = []
+        self.version = None
+        self.users = set()
+        self.client = socketio.Client()
+        self.client.on("multiworker_ping", self.on_ping)
+        self.client.on("presence_snapshot", self.on_snapshot)
+        self.client.on("presence_delta", self.on_delta)
+        self.client.connect(
+            f"http://127.0.0.1:{port}", auth={"presence": "delta"}, transports=["websocket"]
+        )
+
+    def on_ping(self, data):
+        with self.lock:
+            self.pings.append(data["n"])
+
+    def on_snapshot(self, snap):
+        with self.lock:
+            self.version = snap["version"]
+            self.users = set(snap["users"])
+
+    def on_delta(self, delta):
+        with self.lock:
+            if self.version is None or delta["from"] != self.version:
+                self.version = None
+                self.client.emit("get_presence")
+                return
+            self.users |= set(delta["joined"])
+            self.users -= set(delta["left"])
+            self.version = delta["version"]
+            self.versions.append(delta["version"])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--queue")
+    args = parser.parse_args(argv[1:])
+
+    tmp = tempfile.mkdtemp(prefix="multiworker-")
+    procs = []
+    watchers = []
+    try:
+        queue = args.queue
+        if queue is None:
+            redis, queue = start_redis(tmp)
+            procs.append(redis)
+        os.environ.update(
+            DB_PATH=os.path.join(tmp, "app.db"),
+            SOCKETIO_MESSAGE_QUEUE=queue,
+            PRESENCE_WINDOW="0.2",
+            PRESENCE_TTL="60",
+        )
+        import db
+
+        # migrate once up front rather than racing N workers through it
+        db.init_db()
+
+        ports = [free_port() for _ in range(args.workers)]
+        for port in ports:
+            env = dict(os.environ, PORT=str(port))
+            procs.append(subprocess.Popen([sys.executable, "-c", WORKER], cwd=HERE, env=env))
+        for port in ports:
+            wait_port(port)
+        watchers = [Watcher(port) for port in ports]
+        wait_for(lambda: all(w.version is not None for w in watchers))
+
+        failures = []
+
+        # fan-out: an emit from outside any worker reaches every client once
+        from flask_socketio import SocketIO
+
+        external = SocketIO(message_queue=queue)
+        for n in range(3):
+            external.emit("multiworker_ping", {"n": n})
+        if not wait_for(lambda: all(len(w.pings) >= 3 for w in watchers)):
+            failures.append("broadcast did not reach every worker's client")
+        time.sleep(0.5)
+        for w in watchers:
+            if sorted(w.pings) != [0, 1, 2]:
+                failures.append(f"port {w.port} got pings {w.pings}")
+
+        # presence: changes land in the shared store and exactly one worker
+        # turns each window into a delta
+        import dbpool
+        from presence import SharedPresence
+        from writer import writer
+
+        shared = SharedPresence(writer, dbpool.pool)
+        users = [f"user{i}" for i in range(args.workers * 4)]
+        for user in users:
+            shared.touch(user)
+        time.sleep(0.5)
+        for user in users[::3]:
+            shared.remove(user)
+        expected = sorted(set(users) - set(users[::3]))
+        if not wait_for(lambda: all(sorted(w.users) == expected for w in watchers)):
+            failures.append("clients did not converge on the shared presence")
+        for w in watchers:
+            if w.versions != watchers[0].versions:
+                failures.append(f"port {w.port} saw deltas {w.versions}, "
+                                f"port {watchers[0].port} saw {watchers[0].versions}")
+            if w.versions != list(range(1, len(w.versions) + 1)):
+                failures.append(f"port {w.port} saw non-contiguous versions {w.versions}")
+
+        # every worker reports the same snapshot
+        for w in watchers:
+            w.version = None
+            w.client.emit("get_presence")
+        wait_for(lambda: all(w.version is not None for w in watchers))
+        snapshot = shared.snapshot()
+        for w in watchers:
+            if (w.version, sorted(w.users)) != (snapshot["version"], snapshot["users"]):
+                failures.append(f"port {w.port} snapshot differs from the shared store")
+
+        for failure in failures:
+            print("FAIL", failure)
+        if not failures:
+            print(f"ok: {args.workers} workers agree on fan-out and presence")
+        return 1 if failures else 0
+    finally:
+        for w in watchers:
+            w.client.disconnect()
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(timeout=10)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,190 @@
+import heapq
+import os
+import threading
+import time
+
+from db import get_meta, set_meta
+
+PRESENCE_TTL = float(os.environ.get("PRESENCE_TTL", 30))
+PRESENCE_WINDOW = float(os.environ.get("PRESENCE_WINDOW", 1.0))
+
+
+class Presence:
+    # Active users with an expiry deadline each. Deadlines sit in a min-heap;
+    # a ping pushes a new entry and leaves the old one behind, and stale
+    # entries are skipped when they reach the top (and compacted away once
+    # they outnumber the live ones). Membership changes accumulate in
+    # `pending` (user -> whether they were active before the window) until
+    # take_delta() turns them into one versioned join/leave delta.
+
+    def __init__(self, ttl=PRESENCE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.deadlines = {}
+        self.heap = []
+        self.pending = {}
+        self.version = 0
+
+    def touch(self, user, now=None):
+        # record a ping; True if the user just became active
+        deadline = (now if now is not None else time.monotonic()) + self.ttl
+        with self.lock:
+            joined = user not in self.deadlines
+            if joined:
+                self.pending.setdefault(user, False)
+            self.deadlines[user] = deadline
+            heapq.heappush(self.heap, (deadline, user))
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.heap = [(d, u) for u, d in self.deadlines.items()]
+                heapq.heapify(self.heap)
+            return joined
+
+    def remove(self, user):
+        with self.lock:
+            if self.deadlines.pop(user, None) is None:
+                return False
+            self.pending.setdefault(user, True)
+            return True
+
+    def expire(self, now=None):
+        # drop users whose deadline has passed; returns them
+        now = now if now is not None else time.monotonic()
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, user = heapq.heappop(self.heap)
+                if self.deadlines.get(user) == deadline:
+                    del self.deadlines[user]
+                    self.pending.setdefault(user, True)
+                    expired.append(user)
+        return expired
+
+    def take_delta(self):
+        # net changes since the last call as {from, version, joined, left,
+        # count}, or None when membership ended up unchanged
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            joined = sorted(u for u, was in pending.items() if not was and u in self.deadlines)
+            left = sorted(u for u, was in pending.items() if was and u not in self.deadlines)
+            if not joined and not left:
+                return None
+            self.version += 1
+            return {
+                'from': self.version - 1,
+                'version': self.version,
+                'joined': joined,
+                'left': left,
+                'count': len(self.deadlines),
+            }
+
+    def snapshot(self):
+        # may already include changes a later delta repeats; applying a
+        # delta is idempotent, so clients can take it as-is
+        with self.lock:
+            users = sorted(self.deadlines)
+            return {'version': self.version, 'users': users, 'count': len(users)}
+
+
+class SharedPresence:
+    # Same interface as Presence, kept in app.db so every worker process sees
+    # one membership. Writes go through the group-committing writer; expiry
+    # and take_delta run as writer jobs too, so when several workers race for
+    # a window exactly one of them gets the delta and the version stays
+    # consistent. Deadlines are wall-clock, since they cross processes.
+
+    def __init__(self, writer, pool, ttl=PRESENCE_TTL):
+        self.writer = writer
+        self.pool = pool
+        self.ttl = ttl
+
+    def touch(self, user, now=None):
+        deadline = (now if now is not None else time.time()) + self.ttl
+
+        def job(conn):
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO presence_changes (user, was_active)
+                SELECT ?, 0 WHERE NOT EXISTS (SELECT 1 FROM presence WHERE user = ?)
+                """,
+                (user, user),
+            )
+            conn.execute(
+                """
+                INSERT INTO presence (user, deadline) VALUES (?, ?)
+                ON CONFLICT(user) DO UPDATE SET deadline = excluded.deadline
+                """,
+                (user, deadline),
+            )
+
+        # pings don't wait for the commit
+        self.writer.submit(job)
+
+    def remove(self, user):
+        def job(conn):
+            if not conn.execute("DELETE FROM presence WHERE user = ?", (user,)).rowcount:
+                return False
+            conn.execute(
+                "INSERT OR IGNORE INTO presence_changes (user, was_active) VALUES (?, 1)",
+                (user,),
+            )
+            return True
+
+        self.writer.submit(job)
+
+    def expire(self, now=None):
+        now = now if now is not None else time.time()
+
+        def job(conn):
+            expired = [
+                r[0] for r in conn.execute(
+                    "SELECT user FROM presence WHERE deadline <= ?", (now,)
+                )
+            ]
+            if expired:
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO presence_changes (user, was_active)
+                    SELECT user, 1 FROM presence WHERE deadline <= ?
+                    """,
+                    (now,),
+                )
+                conn.execute("DELETE FROM presence WHERE deadline <= ?", (now,))
+            return expired
+
+        return self.writer.submit(job).result()
+
+    def take_delta(self):
+        def job(conn):
+            changes = conn.execute(
+                """
+                SELECT c.user, c.was_active, p.user IS NOT NULL
+                FROM presence_changes c LEFT JOIN presence p ON p.user = c.user
+                """
+            ).fetchall()
+            if not changes:
+                return None
+            conn.execute("DELETE FROM presence_changes")
+            joined = sorted(u for u, was, now in changes if not was and now)
+            left = sorted(u for u, was, now in changes if was and not now)
+            if not joined and not left:
+                return None
+            version = int(get_meta(conn, "presence_version", 0)) + 1
+            set_meta(conn, "presence_version", version)
+            count = conn.execute("SELECT COUNT(*) FROM presence").fetchone()[0]
+            return {
+                'from': version - 1,
+                'version': version,
+                'joined': joined,
+                'left': left,
+                'count': count,
+            }
+
+        return self.writer.submit(job).result()
+
+    def snapshot(self):
+        with self.pool.connection() as conn:
+            # one read transaction, so users and version agree
+            conn.execute("BEGIN")
+            users = [r[0] for r in conn.execute("SELECT user FROM presence ORDER BY user")]
+            version = int(get_meta(conn, "presence_version", 0))
+        return {'version': version, 'users': users, 'count': len(users)}
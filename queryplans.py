@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Checks that the hot queries in app.py are answered from an index.
+#
+#   python queryplans.py [rows]
+#
+# Builds a scratch database through the migrations, seeds it with enough rows
+# that every history path takes its large-table form, runs the real query
+# functions with a trace callback on the pool and prints EXPLAIN QUERY PLAN
+# for each SELECT they issued. Exits non-zero if any step sorts through a
+# temp b-tree or scans a whole table without a LIMIT to stop it.
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+_LIMITED = re.compile(r"\bLIMIT\b", re.I)
+# statements FTS5 issues against its own shadow tables
+_INTERNAL = re.compile(r"'\w+'\.'\w+'")
+
+
+def seed(path, rows):
+    with sqlite3.connect(path) as conn:
+        conn.executemany(
+            """
+            INSERT INTO chat_messages (user, room, message, timestamp, ts, blob_hash, blob_type)
+            VALUES (?, ?, ?, datetime(?, 'unixepoch'), ?, ?, ?)
+            """,
+            (
+                (
+                    f"user{i % 20}",
+                    f"pit{i % 3}" if i % 4 else None,
+                    f"message {i} about trench digging",
+                    1700000000 + i,
+                    (1700000000 + i) * 1000,
+                    f"{i:064x}" if i % 10 == 0 else None,
+                    "image/png" if i % 10 == 0 else None,
+                )
+                for i in range(rows)
+            ),
+        )
+        # reactions on most messages; triggers keep message_counters
+        conn.executemany(
+            "INSERT INTO likes (message_id, user) VALUES (?, ?)",
+            ((i, f"user{i % 20}") for i in range(1, rows + 1) if i % 5),
+        )
+        conn.executemany(
+            "INSERT INTO comments (message_id, user, text) VALUES (?, ?, ?)",
+            ((i, f"user{i % 20}", "nice find") for i in range(1, rows + 1, 7)),
+        )
+        conn.execute("ANALYZE")
+
+
+def exercise(app, rows):
+    # the functions app.py calls on its hot paths, in their big-table forms
+    with app.dbpool.connection() as conn:
+        for room in (None, "pit1"):
+            app.history_query(conn, room=room)[0].fetchall()
+            app.history_query(conn, rows // 2, room=room)[0].fetchall()
+            app.history_query(conn, 50, room=room)[0].fetchall()
+            app.resync_query(conn, rows - 10, room).fetchall()
+            app.resync_query(conn, 1, room)
+            app.search_query(conn, "trench", room=room).fetchall()
+    app.recent.rooms.clear()
+    app.recent.room("pit1", app.dbpool.connection)
+    app.fetch_rows_after(rows // 2, 20)
+    app.blob_type(f"{10:064x}")
+    app.reactions(list(range(rows - 50, rows)))
+    # nothing is that old, so this only runs the archiver's lookups
+    app.archive_old_messages(days=365 * 100)
+
+
+def problems(plan, sql):
+    found = []
+    for _, _, _, detail in plan:
+        if "USE TEMP B-TREE" in detail:
+            found.append(detail)
+            continue
+        if not detail.startswith("SCAN ") or detail == "SCAN CONSTANT ROW":
+            continue
+        # virtual tables (FTS) and index scans are fine, and so is walking the
+        # rowid order when a LIMIT bounds how far it goes
+        if "VIRTUAL TABLE" in detail or " INDEX " in detail or _LIMITED.search(sql):
+            continue
+        found.append(detail)
+    return found
+
+
+def main(argv):
+    rows = int(argv[1]) if len(argv) > 1 else 5000
+    tmp = tempfile.mkdtemp(prefix="queryplans-")
+    os.environ["DB_PATH"] = os.path.join(tmp, "app.db")
+    try:
+        import app
+
+        seed(os.environ["DB_PATH"], rows)
+        statements = []
+        app.dbpool.pool.close_all()
+        app.dbpool.pool.trace = statements.append
+        exercise(app, rows)
+        app.dbpool.pool.trace = None
+        app.dbpool.pool.close_all()
+
+        failed = 0
+        seen = set()
+        with sqlite3.connect(os.environ["DB_PATH"]) as conn:
+            for sql in statements:
+                sql = " ".join(sql.split())
+                if not sql.upper().startswith("SELECT") or _INTERNAL.search(sql) or sql in seen:
+                    continue
+                seen.add(sql)
+                plan = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+                bad = problems(plan, sql)
+                failed += bool(bad)
+                print(("FAIL " if bad else "ok   ") + sql)
+                for _, _, _, detail in plan:
+                    print("       " + detail)
+        if not app.SEARCH_FTS:
+            print("note: no FTS5 in this SQLite build, search used the LIKE fallback")
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,221 @@
+import bisect
+import os
+import threading
+from collections import OrderedDict
+
+RECENT_MAX_MESSAGES = int(os.environ.get("RECENT_MAX_MESSAGES", 1000))
+RECENT_MAX_BYTES = int(os.environ.get("RECENT_MAX_BYTES", 8 * 1024 * 1024))
+RECENT_MAX_ROOMS = int(os.environ.get("RECENT_MAX_ROOMS", 32))
+# more rows than this written elsewhere since the last read drops the
+# buffers (they warm again) rather than routing them all
+RECENT_CATCH_UP_MAX = int(os.environ.get("RECENT_CATCH_UP_MAX", 1000))
+
+
+def row_size(row):
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row)
+
+
+class RecentMessages:
+    # newest chat_messages rows of one room (raw tuples, id first) held in id
+    # order. The buffer always covers a contiguous tail of the room: every
+    # row with id >= rows[0][0] is present, and `older` says whether anything
+    # precedes it. Lookups that can't be answered from that tail return None
+    # so the caller falls back to SQLite.
+
+    def __init__(self, room=None, max_count=RECENT_MAX_MESSAGES, max_bytes=RECENT_MAX_BYTES):
+        self.room = room
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.ids = []
+        self.rows = []
+        self.sizes = []
+        self.bytes = 0
+        self.older = True
+        self.ready = False
+
+    def warm(self, conn, columns):
+        # load the room's tail; the buffer stays out of use (and ignores
+        # appends) until finish()
+        rows = conn.execute(
+            f"SELECT {columns} FROM chat_messages WHERE room IS ? ORDER BY id DESC LIMIT ?",
+            (self.room, self.max_count),
+        ).fetchall()
+        rows.reverse()
+        with self.lock:
+            self.ids, self.rows, self.sizes, self.bytes = [], [], [], 0
+            for row in rows:
+                self._push(row)
+            first = self.ids[0] if self.ids else None
+            self.older = first is not None and conn.execute(
+                "SELECT EXISTS(SELECT 1 FROM chat_messages WHERE room IS ? AND id < ?)",
+                (self.room, first),
+            ).fetchone()[0]
+            self._trim()
+
+    def finish(self, conn, columns, upto):
+        # pull in the room's rows that were routed (and dropped) while
+        # warming, up to and including upto, then go live
+        newest = conn.execute(
+            f"SELECT {columns} FROM chat_messages "
+            "WHERE room IS ? AND id > ? AND id <= ? ORDER BY id",
+            (self.room, self.ids[-1] if self.ids else 0, upto),
+        ).fetchall()
+        with self.lock:
+            for row in newest:
+                self._push(row)
+            self._trim()
+            self.ready = True
+
+    def _push(self, row):
+        size = row_size(row)
+        self.ids.append(row[0])
+        self.rows.append(row)
+        self.sizes.append(size)
+        self.bytes += size
+
+    def _trim(self):
+        drop = 0
+        while len(self.ids) - drop > self.max_count or (
+            self.bytes > self.max_bytes and len(self.ids) - drop > 1
+        ):
+            self.bytes -= self.sizes[drop]
+            drop += 1
+        if drop:
+            del self.ids[:drop], self.rows[:drop], self.sizes[:drop]
+            self.older = True
+
+    def append(self, row):
+        # rows must arrive in id order with none of the room's rows skipped;
+        # RecentRooms takes care of that
+        with self.lock:
+            if not self.ready:
+                return
+            if self.ids and row[0] <= self.ids[-1]:
+                return
+            self._push(row)
+            self._trim()
+
+    def discard_before(self, min_id):
+        # the archiver moved every row below min_id out of the table; the
+        # buffer must not serve them from memory any more
+        with self.lock:
+            cut = bisect.bisect_left(self.ids, min_id)
+            if cut:
+                self.bytes -= sum(self.sizes[:cut])
+                del self.ids[:cut], self.rows[:cut], self.sizes[:cut]
+
+    def page(self, before_id, limit):
+        # (rows, has_more) for the `limit` rows below before_id, or None
+        with self.lock:
+            if not self.ready:
+                return None
+            end = len(self.ids) if before_id is None else bisect.bisect_left(self.ids, before_id)
+            if end >= limit:
+                start = end - limit
+                return self.rows[start:end], start > 0 or self.older
+            if not self.older:
+                return self.rows[:end], False
+            return None
+
+    def after(self, after_id, limit):
+        # rows above after_id, or None when they aren't all buffered or
+        # there are more than `limit` of them
+        with self.lock:
+            if not self.ready:
+                return None
+            if self.older and (not self.ids or after_id < self.ids[0] - 1):
+                return None
+            start = bisect.bisect_right(self.ids, after_id)
+            if len(self.ids) - start > limit:
+                return None
+            return self.rows[start:]
+
+
+class RecentRooms:
+    # a RecentMessages per room (None is the lobby), kept for the max_rooms
+    # most recently read rooms. Every row up to last_id has been routed to
+    # the buffers; a row arriving past a gap first pulls in what was inserted
+    # in between (by another worker or the Node server), so each buffer stays
+    # contiguous.
+
+    def __init__(self, columns, room_index, max_rooms=RECENT_MAX_ROOMS):
+        self.columns = columns
+        self.room_index = room_index
+        self.max_rooms = max_rooms
+        self.lock = threading.Lock()
+        self.rooms = OrderedDict()
+        self.last_id = None
+
+    def room(self, room, connect):
+        # the buffer for room, warmed through connect() on first use. It is
+        # registered before warming so no row routed meanwhile goes unseen:
+        # it drops them while not ready, and finish() fetches them again
+        # under the lock, so nothing can be routed past it in between.
+        with self.lock:
+            buffer = self.rooms.get(room)
+            if buffer is not None:
+                self.rooms.move_to_end(room)
+                return buffer
+            buffer = self.rooms[room] = RecentMessages(room)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        try:
+            with connect() as conn:
+                buffer.warm(conn, self.columns)
+                with self.lock:
+                    if self.last_id is None:
+                        newest = conn.execute("SELECT MAX(id) FROM chat_messages").fetchone()[0]
+                        self.last_id = newest or 0
+                    buffer.finish(conn, self.columns, self.last_id)
+        except BaseException:
+            with self.lock:
+                if self.rooms.get(room) is buffer:
+                    del self.rooms[room]
+            raise
+        return buffer
+
+    def _route(self, row):
+        buffer = self.rooms.get(row[self.room_index])
+        if buffer is not None:
+            buffer.append(row)
+        if self.last_id is None or row[0] > self.last_id:
+            self.last_id = row[0]
+
+    def append(self, row, fetch, limit=RECENT_CATCH_UP_MAX):
+        # a row past a gap first catches up on what was inserted in between;
+        # the row is committed, so that catch-up routes it too (or resets)
+        while True:
+            with self.lock:
+                if self.last_id is None or row[0] <= self.last_id + 1:
+                    self._route(row)
+                    return
+            self.catch_up(fetch, limit)
+
+    def catch_up(self, fetch, limit=RECENT_CATCH_UP_MAX):
+        # fetch(after_id, limit) returns up to `limit` of the rows inserted
+        # elsewhere since last_id. It runs outside the lock, so readers
+        # never queue behind it; whatever was routed meanwhile is skipped,
+        # and the rest still continues last_id without a gap
+        with self.lock:
+            after = self.last_id
+        if after is None:
+            return
+        rows = fetch(after, limit + 1)
+        with self.lock:
+            if self.last_id is None:
+                return
+            if len(rows) > limit:
+                self.rooms.clear()
+                self.last_id = None
+                return
+            for row in rows:
+                if row[0] > self.last_id:
+                    self._route(row)
+
+    def discard_before(self, min_id):
+        # called by app.archive_old_messages after each deleted batch
+        with self.lock:
+            buffers = list(self.rooms.values())
+        for buffer in buffers:
+            buffer.discard_before(min_id)
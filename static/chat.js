@@ -1,5 +1,6 @@
 (function(){
   let chatSocket = null;
+  const HISTORY_PAGE_SIZE = 100;
   function createBox(){
     const ctx = window.APP_CONTEXT || {};
     const box = document.createElement('div');
@@ -48,13 +49,23 @@
     usersBox.style.letterSpacing = '0.12em';
     usersBox.style.fontSize = '11px';
     const sendAllowed = !!ctx.username;
-    const socket = io();
-    chatSocket = socket;
-    socket.on('connect', () => {
-      socket.emit('get_chat_history');
+    let newestId = null;
+    // the server pushes the newest history page on connect, or only the
+    // messages after newestId when reconnecting
+    // proto 2 asks for columnar history chunks, deflated when large if the
+    // browser can inflate them
+    const canInflate = typeof DecompressionStream !== 'undefined';
+    const socket = io({
+      auth: cb => cb({ paged: true, proto: 2, z: canInflate, last_id: newestId, presence: 'delta', room: ctx.room || null })
     });
-    function appendMsg(data){
+    chatSocket = socket;
+    let oldestId = null;
+    let hasMore = false;
+    let loadingOlder = false;
+    let searching = false;
+    function buildMsg(data){
       const msg = document.createElement('div');
+      if(data.id != null) msg.dataset.id = data.id;
       msg.style.marginBottom = '10px';
       msg.style.padding = '12px';
       msg.style.background = 'rgba(16,24,46,0.72)';
@@ -70,9 +81,18 @@
       msg.appendChild(header);
       const fileName = data.file_name || data.fileName;
       const fileType = data.file_type || data.fileType || '';
+      const thumb = data.attachment && data.attachment.thumb;
       if(data.image){
         const img = document.createElement('img');
-        img.src = data.image;
+        img.loading = 'lazy';
+        img.src = thumb || data.image;
+        if(thumb){
+          // the full image is only fetched when the preview is clicked
+          const showOriginal = () => { img.src = data.image; };
+          img.style.cursor = 'zoom-in';
+          img.addEventListener('click', showOriginal, { once: true });
+          img.addEventListener('error', showOriginal, { once: true });
+        }
         img.alt = fileName || data.message || 'image';
         img.style.maxWidth = '100%';
         img.style.borderRadius = '12px';
@@ -83,6 +103,8 @@
         if(type.startsWith('video/')){
           const vid = document.createElement('video');
           vid.src = data.file;
+          vid.preload = 'none';
+          if(thumb) vid.poster = thumb;
           vid.controls = true;
           vid.style.maxWidth = '100%';
           vid.style.borderRadius = '12px';
@@ -107,21 +129,255 @@
           msg.appendChild(link);
         }
       }
-      feed.appendChild(msg);
+      if(data.id != null) msg.appendChild(buildReactions(data.id));
+      return msg;
+    }
+    // like and comment counts arrive after the page (get_reactions) and as
+    // coalesced message_likes / message_comment updates
+    function buildReactions(id){
+      const bar = document.createElement('div');
+      bar.style.marginTop = '8px';
+      bar.style.fontSize = '12px';
+      const likes = document.createElement('button');
+      const comments = document.createElement('button');
+      const thread = document.createElement('div');
+      likes.dataset.role = 'likes';
+      comments.dataset.role = 'comments';
+      thread.dataset.role = 'thread';
+      [likes, comments].forEach(btn => {
+        btn.type = 'button';
+        btn.style.marginRight = '8px';
+        btn.style.background = 'transparent';
+        btn.style.border = '0';
+        btn.style.color = '#9aa3c8';
+        btn.style.cursor = 'pointer';
+        bar.appendChild(btn);
+      });
+      likes.textContent = '\u2665 0';
+      comments.textContent = '\u{1F4AC} 0';
+      thread.style.display = 'none';
+      thread.style.marginTop = '6px';
+      likes.disabled = !sendAllowed;
+      likes.addEventListener('click', () => socket.emit('like_message', { message_id: id }));
+      comments.addEventListener('click', () => {
+        thread.style.display = thread.style.display === 'none' ? 'block' : 'none';
+      });
+      if(sendAllowed){
+        const reply = document.createElement('input');
+        reply.placeholder = 'Comment...';
+        reply.style.width = '100%';
+        reply.style.marginTop = '4px';
+        reply.style.background = 'transparent';
+        reply.style.border = '1px solid rgba(123,157,255,0.25)';
+        reply.style.borderRadius = '8px';
+        reply.style.color = '#f5f7ff';
+        reply.addEventListener('keydown', e => {
+          if(e.key !== 'Enter' || !reply.value.trim()) return;
+          socket.emit('comment_message', { message_id: id, text: reply.value.trim() });
+          reply.value = '';
+        });
+        thread.appendChild(reply);
+      }
+      bar.appendChild(thread);
+      return bar;
+    }
+    function reactionNode(id, role){
+      return feed.querySelector(`[data-id="${id}"] [data-role="${role}"]`);
+    }
+    function setCount(id, role, count){
+      const node = reactionNode(id, role);
+      if(!node) return;
+      node.dataset.count = count;
+      node.textContent = `${role === 'likes' ? '\u2665' : '\u{1F4AC}'} ${count}`;
+    }
+    function addComment(c){
+      const thread = reactionNode(c.message_id, 'thread');
+      if(!thread || thread.querySelector(`[data-comment="${c.id}"]`)) return false;
+      const line = document.createElement('div');
+      line.dataset.comment = c.id;
+      line.textContent = `${c.user}: ${c.text}`;
+      thread.insertBefore(line, thread.querySelector('input'));
+      return true;
+    }
+    function loadReactions(list){
+      const ids = list.map(data => data.id).filter(id => id != null);
+      if(!ids.length) return;
+      socket.emit('get_reactions', { message_ids: ids }, res => {
+        if(!res) return;
+        res.counts.forEach(([id, likes, comments]) => {
+          setCount(id, 'likes', likes);
+          setCount(id, 'comments', comments);
+        });
+        res.comments.forEach(addComment);
+      });
+    }
+    function appendMsg(data){
+      feed.appendChild(buildMsg(data));
       feed.scrollTop = feed.scrollHeight;
     }
     function renderMessages(list){
       feed.innerHTML = '';
+      oldestId = null;
       list.forEach(appendMsg);
+      loadReactions(list);
+    }
+    function insertMessages(list, before){
+      const prevHeight = feed.scrollHeight;
+      const frag = document.createDocumentFragment();
+      list.forEach(data => frag.appendChild(buildMsg(data)));
+      feed.insertBefore(frag, before);
+      feed.scrollTop += feed.scrollHeight - prevHeight;
+    }
+    function noteNewest(list){
+      list.forEach(data => {
+        if(data.id != null && (newestId === null || data.id > newestId)) newestId = data.id;
+      });
+    }
+    // results arrive as numbered chunks followed by an *_end marker; older
+    // pages are inserted above the message that was on top when they began
+    let pageAnchor = null;
+    async function decodeChunk(chunk){
+      if(chunk.messages) return chunk.messages;
+      let cols = chunk;
+      if(chunk.z){
+        const stream = new Blob([chunk.z]).stream().pipeThrough(new DecompressionStream('deflate'));
+        cols = JSON.parse(await new Response(stream).text());
+      }
+      return (cols.rows || []).map(row => {
+        const data = {};
+        cols.keys.forEach((key, i) => { data[key] = row[i]; });
+        return data;
+      });
     }
-    socket.on('chat_history', renderMessages);
-    socket.on('chat_search_results', renderMessages);
-    socket.on('chat_message', appendMsg);
+    // chunks may need async inflating, so every feed update is queued to
+    // keep chunks, end markers and live messages in arrival order
+    let inbox = Promise.resolve();
+    function ordered(fn, decode){
+      return payload => {
+        inbox = inbox
+          .then(async () => fn(payload, decode ? await decodeChunk(payload) : undefined))
+          .catch(err => console.error(err));
+      };
+    }
+    function onHistoryChunk(chunk, list){
+      const older = chunk.before_id != null;
+      if(chunk.seq === 0){
+        if(older){
+          pageAnchor = feed.firstChild;
+        } else {
+          searching = false;
+          feed.innerHTML = '';
+        }
+        if(list.length) oldestId = list[0].id;
+      }
+      noteNewest(list);
+      if(older){
+        insertMessages(list, pageAnchor);
+      } else {
+        list.forEach(appendMsg);
+      }
+      loadReactions(list);
+    }
+    function onHistoryEnd(end){
+      if(end.chunks === 0 && end.before_id == null){
+        searching = false;
+        renderMessages([]);
+      }
+      hasMore = !!end.has_more;
+      loadingOlder = false;
+    }
+    function loadOlder(){
+      if(searching || loadingOlder || !hasMore || oldestId === null) return;
+      loadingOlder = true;
+      socket.emit('get_chat_history', { before_id: oldestId, limit: HISTORY_PAGE_SIZE });
+    }
+    feed.addEventListener('scroll', () => {
+      if(feed.scrollTop < 40) loadOlder();
+    });
+    function onResyncChunk(chunk, messages){
+      const list = messages.filter(
+        data => !feed.querySelector(`[data-id="${data.id}"]`)
+      );
+      noteNewest(list);
+      if(searching) return;
+      list.forEach(appendMsg);
+      loadReactions(list);
+    }
+    function onSearchChunk(chunk, list){
+      if(chunk.seq === 0){
+        searching = true;
+        feed.innerHTML = '';
+      }
+      list.forEach(appendMsg);
+      loadReactions(list);
+    }
+    socket.on('chat_history', ordered(renderMessages));
+    socket.on('chat_history_chunk', ordered(onHistoryChunk, true));
+    socket.on('chat_history_end', ordered(onHistoryEnd));
+    socket.on('chat_resync_chunk', ordered(onResyncChunk, true));
+    socket.on('chat_search_chunk', ordered(onSearchChunk, true));
+    socket.on('chat_search_end', ordered(end => {
+      if(end.chunks === 0){
+        searching = true;
+        feed.innerHTML = '';
+      }
+    }));
+    socket.on('chat_message', ordered(data => {
+      noteNewest([data]);
+      if(!searching) appendMsg(data);
+    }));
+    socket.on('message_likes', update => {
+      update.likes.forEach(([id, count]) => setCount(id, 'likes', count));
+    });
+    socket.on('message_comment', comment => {
+      if(!addComment(comment)) return;
+      const node = reactionNode(comment.message_id, 'comments');
+      setCount(comment.message_id, 'comments', (Number(node.dataset.count) || 0) + 1);
+    });
     socket.on('chat_error', msg => {
       alert(msg);
     });
-    socket.on('active_user_update', data => {
-      usersBox.textContent = `Active users (${data.count}): ${data.users.join(', ')}`;
+    // presence arrives as a versioned snapshot followed by join/leave deltas;
+    // a delta that doesn't continue from our version means we missed one
+    let presenceVersion = null;
+    const userNodes = new Map();
+    usersBox.innerHTML = 'Active users (<span>0</span>): <span></span>';
+    const [userCount, userList] = usersBox.querySelectorAll('span');
+    function addUser(name){
+      if(userNodes.has(name)) return;
+      const node = document.createElement('span');
+      node.textContent = name;
+      node.style.marginRight = '8px';
+      userNodes.set(name, node);
+      userList.appendChild(node);
+    }
+    function removeUser(name){
+      const node = userNodes.get(name);
+      if(!node) return;
+      node.remove();
+      userNodes.delete(name);
+    }
+    function showUserCount(){
+      userCount.textContent = userNodes.size;
+    }
+    socket.on('presence_snapshot', snap => {
+      presenceVersion = snap.version;
+      userNodes.clear();
+      userList.textContent = '';
+      snap.users.forEach(addUser);
+      showUserCount();
+    });
+    socket.on('presence_delta', delta => {
+      if(presenceVersion === null) return;
+      if(delta.from !== presenceVersion){
+        presenceVersion = null;
+        socket.emit('get_presence');
+        return;
+      }
+      delta.joined.forEach(addUser);
+      delta.left.forEach(removeUser);
+      presenceVersion = delta.version;
+      showUserCount();
     });
     if(!sendAllowed){
       input.disabled = true;
@@ -135,10 +391,53 @@
         if(q){
           socket.emit('search_chat', {query: q});
         } else {
-          socket.emit('get_chat_history');
+          socket.emit('get_chat_history', { limit: HISTORY_PAGE_SIZE });
         }
       }, 300);
     });
+    function request(event, payload){
+      return new Promise((resolve, reject) => {
+        socket.emit(event, payload, res => {
+          if(res && res.error) reject(new Error(res.error));
+          else resolve(res || {});
+        });
+      });
+    }
+    // uploads go up as binary chunks; the upload id is remembered so a
+    // reload or reconnect only sends the ranges the server is missing
+    async function uploadFile(file, txt){
+      const key = `chat_upload:${file.name}:${file.size}:${file.lastModified}`;
+      let uploadId = localStorage.getItem(key);
+      let chunkSize = 256 * 1024;
+      let missing = null;
+      if(uploadId){
+        try {
+          missing = (await request('upload_status', { upload_id: uploadId })).missing;
+        } catch {
+          uploadId = null;
+        }
+      }
+      if(!uploadId){
+        const init = await request('upload_init', {
+          size: file.size, file_name: file.name, file_type: file.type
+        });
+        uploadId = init.upload_id;
+        chunkSize = Math.min(chunkSize, init.chunk_size || chunkSize);
+        missing = [[0, file.size]];
+        localStorage.setItem(key, uploadId);
+      }
+      for(let attempt = 0; missing.length && attempt < 5; attempt++){
+        for(const [start, end] of missing){
+          for(let offset = start; offset < end; offset += chunkSize){
+            const data = await file.slice(offset, Math.min(offset + chunkSize, end)).arrayBuffer();
+            await request('upload_chunk', { upload_id: uploadId, offset, data });
+          }
+        }
+        missing = (await request('upload_status', { upload_id: uploadId })).missing;
+      }
+      await request('upload_finish', { upload_id: uploadId, message: txt });
+      localStorage.removeItem(key);
+    }
     form.addEventListener('submit', e => {
       e.preventDefault();
       if(!sendAllowed){
@@ -148,21 +447,7 @@
       const txt = input.value.trim();
       const file = fileInput.files[0];
       if(file){
-        const reader = new FileReader();
-        reader.onload = () => {
-          const payload = { message: txt };
-          if(file.type.startsWith('image/')){
-            payload.image = reader.result;
-          } else {
-            payload.file = reader.result;
-          }
-            payload.file_name = file.name;
-            payload.file_type = file.type;
-            payload.fileName = file.name;
-            payload.fileType = file.type;
-          socket.emit('chat_message', payload);
-        };
-        reader.readAsDataURL(file);
+        uploadFile(file, txt).catch(err => alert(err.message || err));
         fileInput.value = '';
         input.value = '';
       } else if(txt){
@@ -170,6 +455,7 @@
         input.value = '';
       }
     });
+    socket.lastSeenId = () => (searching ? null : newestId);
     return box;
   }
 
@@ -179,7 +465,7 @@
       const showing = box.style.display === 'none';
       box.style.display = showing ? 'block' : 'none';
       if(showing && chatSocket){
-        chatSocket.emit('get_chat_history');
+        chatSocket.emit('resync_chat', { last_id: chatSocket.lastSeenId() });
       }
       return;
     }
@@ -29,7 +29,8 @@
       });
       // keep socket connection alive for active user tracking
       sio.onload = () => {
-        const socket = io();
+        // pings only; the chat box socket receives the presence updates
+        const socket = io({auth: {presence: 'none'}});
         socket.on('connect', () => {
           socket.emit('user_ping');
           setInterval(() => socket.emit('user_ping'), 10000);
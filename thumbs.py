@@ -0,0 +1,143 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+import blobstore
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional; callers fall back to the original
+    Image = None
+
+THUMB_DIR = os.environ.get("THUMB_DIR", os.path.join(blobstore.BLOB_DIR, "thumbs"))
+THUMB_SIZE = int(os.environ.get("THUMB_SIZE", 320))
+THUMB_CACHE_BYTES = int(os.environ.get("THUMB_CACHE_BYTES", 256 * 1024 * 1024))
+FFMPEG = shutil.which("ffmpeg")
+
+
+def supports(mime):
+    mime = mime or ""
+    if mime.startswith("image/"):
+        return Image is not None and mime != "image/svg+xml"
+    if mime.startswith("video/"):
+        return FFMPEG is not None
+    return False
+
+
+class ThumbCache:
+    # on-disk LRU: recency lives in an OrderedDict seeded from file mtimes,
+    # and the oldest thumbnails are deleted once the total passes max_bytes
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None
+        self.total = 0
+
+    def _load(self):
+        self.entries = OrderedDict()
+        self.total = 0
+        if not os.path.isdir(self.root):
+            return
+        files = []
+        for name in os.listdir(self.root):
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total += size
+
+    def get(self, name):
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        path = os.path.join(self.root, name)
+        try:
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.total -= self.entries.pop(name, 0)
+            return None
+        return path
+
+    def put(self, name, tmp):
+        path = os.path.join(self.root, name)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            self.total += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                old, old_size = self.entries.popitem(last=False)
+                self.total -= old_size
+                try:
+                    os.unlink(os.path.join(self.root, old))
+                except OSError:
+                    pass
+        return path
+
+
+cache = ThumbCache(THUMB_DIR, THUMB_CACHE_BYTES)
+
+
+def _render_image(src, dest):
+    with Image.open(src) as im:
+        im.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        im.save(dest, "JPEG", quality=80, optimize=True)
+
+
+def _render_video(src, dest):
+    subprocess.run(
+        [
+            FFMPEG, "-v", "error", "-y", "-ss", "1", "-i", src,
+            "-frames:v", "1", "-vf", f"scale={THUMB_SIZE}:-2", "-f", "image2", dest,
+        ],
+        check=True,
+        timeout=30,
+    )
+
+
+def thumbnail(digest, mime):
+    # path of a JPEG preview for the blob, rendered on first request;
+    # None when no renderer is available or rendering fails
+    if not supports(mime):
+        return None
+    name = f"{digest}.jpg"
+    path = cache.get(name)
+    if path:
+        return path
+    src = blobstore.blob_path(digest)
+    if not os.path.exists(src):
+        return None
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=THUMB_DIR, prefix=".tmp-", suffix=".jpg")
+    os.close(fd)
+    try:
+        if mime.startswith("image/"):
+            _render_image(src, tmp)
+        else:
+            _render_video(src, tmp)
+        if os.path.getsize(tmp) == 0:
+            return None
+        return cache.put(name, tmp)
+    except Exception:
+        return None
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import blobstore
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(blobstore.BLOB_DIR, "uploads"))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 35 * 1024 * 1024))
+# stay under Socket.IO's default 1 MB max_http_buffer_size
+UPLOAD_CHUNK_MAX = int(os.environ.get("UPLOAD_CHUNK_MAX", 512 * 1024))
+UPLOAD_TTL = int(os.environ.get("UPLOAD_TTL", 24 * 3600))
+
+_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    pass
+
+
+def _paths(upload_id):
+    if (not isinstance(upload_id, str) or not upload_id
+            or not all(ch in "0123456789abcdef" for ch in upload_id)):
+        raise UploadError("Unknown upload.")
+    base = os.path.join(UPLOAD_DIR, upload_id)
+    return base + ".part", base + ".json"
+
+
+def _load(upload_id):
+    part, meta_path = _paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise UploadError("Unknown upload.")
+
+
+def _save(meta):
+    _, meta_path = _paths(meta["id"])
+    tmp = meta_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_path)
+
+
+def _merge(ranges, start, end):
+    # ranges are sorted, non-overlapping [start, end) pairs
+    out = []
+    for s, e in sorted(ranges + [[start, end]]):
+        if out and s <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], e)
+        else:
+            out.append([s, e])
+    return out
+
+
+def purge_stale(now=None):
+    now = now or time.time()
+    if not os.path.isdir(UPLOAD_DIR):
+        return
+    for name in os.listdir(UPLOAD_DIR):
+        path = os.path.join(UPLOAD_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > UPLOAD_TTL:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+def start(user, size, name=None, mime=None):
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("Invalid upload size.")
+    if size < 0 or size > UPLOAD_MAX_BYTES:
+        raise UploadError("File is too large.")
+    purge_stale()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    meta = {
+        "id": uuid.uuid4().hex,
+        "user": user,
+        "size": size,
+        "name": name if isinstance(name, str) else None,
+        "type": blobstore.normalize_type(mime),
+        "ranges": [],
+    }
+    part, _ = _paths(meta["id"])
+    with open(part, "wb") as f:
+        f.truncate(size)
+    _save(meta)
+    return meta
+
+
+def write_chunk(user, upload_id, offset, data):
+    if not isinstance(data, (bytes, bytearray)):
+        raise UploadError("Chunk must be binary.")
+    if len(data) > UPLOAD_CHUNK_MAX:
+        raise UploadError("Chunk is too large.")
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise UploadError("Invalid chunk offset.")
+    with _lock:
+        meta = _load(upload_id)
+        if meta["user"] != user:
+            raise UploadError("Unknown upload.")
+        end = offset + len(data)
+        if offset < 0 or end > meta["size"]:
+            raise UploadError("Chunk is outside the file.")
+        part, _ = _paths(upload_id)
+        with open(part, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        if data:
+            meta["ranges"] = _merge(meta["ranges"], offset, end)
+            _save(meta)
+    return meta
+
+
+def missing(meta):
+    gaps = []
+    pos = 0
+    for s, e in meta["ranges"]:
+        if s > pos:
+            gaps.append([pos, s])
+        pos = max(pos, e)
+    if pos < meta["size"]:
+        gaps.append([pos, meta["size"]])
+    return gaps
+
+
+def status(user, upload_id):
+    with _lock:
+        meta = _load(upload_id)
+    if meta["user"] != user:
+        raise UploadError("Unknown upload.")
+    return meta
+
+
+def finish(user, upload_id):
+    # move the completed file into the blob store; returns (meta, blob)
+    with _lock:
+        meta = _load(upload_id)
+        if meta["user"] != user:
+            raise UploadError("Unknown upload.")
+        if missing(meta):
+            raise UploadError("Upload is incomplete.")
+        part, meta_path = _paths(upload_id)
+        digest, size = blobstore.put_file(part)
+        os.unlink(meta_path)
+    return meta, (digest, size, meta["type"])
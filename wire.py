@@ -0,0 +1,98 @@
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+WIRE_CACHE_SIZE = int(os.environ.get("WIRE_CACHE_SIZE", 5000))
+# the threshold applies to each chunk on its own, and a full chunk is only
+# STREAM_CHUNK_SIZE messages, so it sits well below a typical chunk's size
+WIRE_COMPRESS_MIN = int(os.environ.get("WIRE_COMPRESS_MIN", 2 * 1024))
+
+_RAW_TOKEN = re.compile(r'"\\u0000([0-9a-f]{16}):(\d+)\\u0000"')
+
+
+class RawJSON:
+    # an already-encoded JSON value that is spliced into packets verbatim
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return f"RawJSON({self.text!r})"
+
+
+class _Encoder(json.JSONEncoder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.raw = []
+        # per-call nonce, so no string in the payload can forge a placeholder
+        self.nonce = os.urandom(8).hex()
+
+    def default(self, o):
+        if isinstance(o, RawJSON):
+            # a placeholder the C encoder can emit; swapped out afterwards
+            self.raw.append(o.text)
+            return f"\x00{self.nonce}:{len(self.raw) - 1}\x00"
+        return super().default(o)
+
+
+def dumps(obj, **kwargs):
+    # drop-in for json.dumps, handed to SocketIO(json=...) so packets can
+    # embed cached RawJSON fragments without re-encoding them
+    kwargs.setdefault("separators", (",", ":"))
+    encoder = _Encoder(**kwargs)
+    text = encoder.encode(obj)
+    if encoder.raw:
+        raw, nonce = encoder.raw, encoder.nonce
+
+        def splice(m):
+            return raw[int(m.group(2))] if m.group(1) == nonce else m.group(0)
+
+        text = _RAW_TOKEN.sub(splice, text)
+    return text
+
+
+loads = json.loads
+
+
+def encode(value):
+    return RawJSON(json.dumps(value, separators=(",", ":")))
+
+
+def columnar(keys, rows, compress=False):
+    # compact chunk: keys once, each row an encoded array in the same order.
+    # A chunk of at least WIRE_COMPRESS_MIN bytes is deflated (zlib) and sent
+    # as a binary attachment
+    if compress:
+        text = (
+            '{"keys":' + json.dumps(list(keys), separators=(",", ":"))
+            + ',"rows":[' + ",".join(r.text for r in rows) + "]}"
+        )
+        if len(text) >= WIRE_COMPRESS_MIN:
+            return {"v": 2, "z": zlib.compress(text.encode("utf-8"), 6)}
+    return {"v": 2, "keys": list(keys), "rows": rows}
+
+
+class WireCache:
+    # LRU of encoded messages keyed by (message id, encoding)
+
+    def __init__(self, max_entries=WIRE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, build):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
@@ -0,0 +1,114 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import dbpool
+
+WRITE_BATCH_MAX = int(os.environ.get("WRITE_BATCH_MAX", 200))
+WRITE_BATCH_DELAY = float(os.environ.get("WRITE_BATCH_DELAY", 0.002))
+WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", 10))
+
+
+class Writer:
+    # Single writer with group commit: callers enqueue statements and block
+    # until the batch holding theirs is committed. The writer thread drains
+    # up to max_batch jobs, waiting at most max_delay for stragglers, and
+    # commits them in one transaction. Each job runs under a savepoint so a
+    # failing statement only fails its own caller.
+
+    def __init__(self, pool=None, max_batch=WRITE_BATCH_MAX, max_delay=WRITE_BATCH_DELAY):
+        self.pool = pool or dbpool.pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+            self.thread.start()
+
+    def submit(self, fn):
+        # fn(conn) runs inside the batch transaction; returns a Future
+        future = Future()
+        self._ensure_started()
+        self.jobs.put((fn, future))
+        return future
+
+    def run(self, fn):
+        # run fn(conn) through the writer and wait for its result. On timeout
+        # the job is cancelled, so TimeoutError means it never ran; a job
+        # that already started holds the write lock and finishes soon, so
+        # its outcome is awaited instead
+        future = self.submit(fn)
+        try:
+            return future.result(WRITE_TIMEOUT)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    def execute(self, sql, params=()):
+        # run one statement through the writer and return its lastrowid
+        return self.run(lambda conn: conn.execute(sql, params).lastrowid)
+
+    def _collect(self):
+        batch = [self.jobs.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.jobs.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._commit(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit(self, batch):
+        results = []
+        with self.pool.connection() as conn:
+            # explicit transaction, so releasing a savepoint never commits
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, fn(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+        # results are only handed out once the whole batch is durable
+        for future, value, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(value)
+
+
+writer = Writer()
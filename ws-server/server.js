@@ -1,6 +1,7 @@
 // server.js
 import http from "http";
 import { readFile, stat } from "fs/promises";
+import { readdirSync, readFileSync } from "fs";
 import path from "path";
 import { fileURLToPath } from "url";
 import { WebSocketServer } from "ws";
@@ -14,39 +15,63 @@ const ROOT = path.resolve(__dirname, "..");
 
 const DB_PATH = process.env.DB_PATH || path.join(ROOT, "app.db");
 const db = new Database(DB_PATH);
-db.exec(`
-  CREATE TABLE IF NOT EXISTS chat_messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user TEXT,
-    room TEXT,
-    message TEXT,
-    image TEXT,
-    file TEXT,
-    file_name TEXT,
-    file_type TEXT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-  );
-  CREATE TABLE IF NOT EXISTS comments (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    message_id INTEGER,
-    user TEXT,
-    text TEXT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-  );
-  CREATE TABLE IF NOT EXISTS likes (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    message_id INTEGER,
-    user TEXT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE(message_id, user)
-  );
-`);
-try { db.exec("ALTER TABLE chat_messages ADD COLUMN room TEXT"); } catch {}
+// match the Python pool: WAL so readers never block the writer
+db.pragma("journal_mode = WAL");
+db.pragma("busy_timeout = 5000");
+db.pragma("synchronous = NORMAL");
+migrate(db);
+
+// Same migration files and user_version bookkeeping as db.py's migrate():
+// numbered .sql files in migrations/, each applied once in a transaction.
+function migrate(db) {
+  const dir = path.join(ROOT, "migrations");
+  const files = readdirSync(dir)
+    .filter((f) => /^\d+_[\w-]+\.sql$/.test(f))
+    .sort((a, b) => parseInt(a, 10) - parseInt(b, 10));
+  const hasColumn = (table, column) =>
+    db.prepare(`PRAGMA table_info(${table})`).all().some((c) => c.name === column);
+  for (const file of files) {
+    const version = parseInt(file, 10);
+    if (version <= db.pragma("user_version", { simple: true })) continue;
+    const sql = readFileSync(path.join(dir, file), "utf8");
+    const directives = [];
+    for (const line of sql.split("\n")) {
+      const m = line.trim().match(/^--\s*(ensure-column|requires-column|optional)\b:?\s*(.*)$/);
+      if (m) directives.push([m[1], m[2].split(/\s+/)]);
+    }
+    // nested transaction functions run as savepoints, so a failed optional
+    // migration only rolls back its own statements
+    const apply = db.transaction(() => {
+      db.exec(sql);
+      for (const [kind, args] of directives) {
+        if (kind !== "ensure-column") continue;
+        const [table, column, ...definition] = args;
+        if (!hasColumn(table, column)) {
+          db.exec(`ALTER TABLE ${table} ADD COLUMN ${column} ${definition.join(" ")}`);
+        }
+      }
+    });
+    db.transaction(() => {
+      if (db.pragma("user_version", { simple: true }) >= version) return;
+      const skip = directives.some(
+        ([kind, args]) => kind === "requires-column" && !hasColumn(args[0], args[1])
+      );
+      if (!skip) {
+        try {
+          apply();
+        } catch (err) {
+          if (!directives.some(([kind]) => kind === "optional")) throw err;
+        }
+      }
+      db.pragma(`user_version = ${version}`);
+    }).immediate();
+  }
+}
 
 function loadHistory() {
   const rows = db
     .prepare(
-      `SELECT id, user, room, message, image, file, file_name, file_type, strftime('%s', timestamp) * 1000 as ts FROM chat_messages ORDER BY id`
+      `SELECT id, user, room, message, image, file, file_name, file_type, COALESCE(ts, strftime('%s', timestamp) * 1000) as ts FROM chat_messages ORDER BY id`
     )
     .all();
   const commentRows = db
@@ -55,7 +80,7 @@ function loadHistory() {
     )
     .all();
   const likeRows = db
-    .prepare(`SELECT message_id, COUNT(*) as c FROM likes GROUP BY message_id`)
+    .prepare(`SELECT message_id, likes as c FROM message_counters WHERE likes > 0`)
     .all();
   const comments = {};
   for (const c of commentRows) {
@@ -451,8 +476,8 @@ wss.on("connection", (ws) => {
           )
           .run(msg.messageId, msg.user || "");
         const count = db
-          .prepare("SELECT COUNT(*) as c FROM likes WHERE message_id = ?")
-          .get(msg.messageId).c;
+          .prepare("SELECT likes as c FROM message_counters WHERE message_id = ?")
+          .get(msg.messageId)?.c ?? 0;
         const payload = { type: "like", messageId: msg.messageId, count };
         for (const client of wss.clients) {
           if (client.readyState === 1) client.send(JSON.stringify(payload));
@@ -479,14 +504,16 @@ wss.on("connection", (ws) => {
     // higher than the desired byte thresholds.
     if (msg.image && msg.image.length > 20_000_000) return; // limit ~15MB per image
     if (msg.file && msg.file.length > 50_000_000) return; // limit ~35MB per file
-    msg.ts ||= Date.now();
+    // the server's clock, never the client's: ts decides when and where a
+    // message is archived
+    msg.ts = Date.now();
     const text = msg.text ?? msg.message ?? "";
     msg.text = text;
     const fileName = msg.file_name || msg.fileName || null;
     const fileType = msg.file_type || msg.fileType || null;
     const info = db
       .prepare(
-        "INSERT INTO chat_messages (user, room, message, image, file, file_name, file_type) VALUES (?, ?, ?, ?, ?, ?, ?)"
+        "INSERT INTO chat_messages (user, room, message, image, file, file_name, file_type, ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
       )
       .run(
         msg.user || "",
@@ -495,7 +522,8 @@ wss.on("connection", (ws) => {
         msg.image || null,
         msg.file || null,
         fileName,
-        fileType
+        fileType,
+        msg.ts
     );
     msg.id = info.lastInsertRowid;
     msg.message = text;